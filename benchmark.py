@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Benchmarks for the docx and html writers.
+
+Every benchmark builds, writes, loads or updates a synthetic document, or
+builds content objects without a document to measure their size. It runs
+in a fresh process, so that the peak memory of one benchmark does not
+hide that of the next one. The results are printed and may be saved as a
+JSON report, which can be compared with an earlier report:
+
+    python benchmark.py -o before.json
+    (change something)
+    python benchmark.py -o after.json -c before.json
+
+Run "python benchmark.py -h" for all options.
+'''
+
+import sys
+import os
+import gc
+import json
+import time
+import shutil
+import tempfile
+import platform
+import argparse
+import subprocess
+
+try:
+    import resource
+    _have_resource = True
+except ImportError:
+    _have_resource = False
+
+try:
+    import tracemalloc
+    _have_tracemalloc = True
+except ImportError:
+    _have_tracemalloc = False
+
+import docx
+import html
+
+benchmarks = [ ]
+
+def benchmark(size, setup = None):
+    '''Register a benchmark function.
+
+    The function is called with the document size (multiplied by the scale
+    of the run), the backend name, and the result of setup(workdir, size,
+    backend) if given. Setup is not timed. If the function returns a list
+    of objects, the memory they use is reported per object.
+    '''
+    def register(func):
+        benchmarks.append((func.__name__, func, size, setup))
+        return func
+    return register
+
+def _write(doc, workdir, name):
+    fname = os.path.join(workdir, name)
+    doc.writeto(fname)
+    return fname
+
+@benchmark(10000)
+def docx_paragraphs(n, backend, workdir):
+    doc = docx.Document(backend = backend)
+    for i in range(n):
+        p = docx.Paragraph(docx.Text('Paragraph %i ' % i))
+        p += docx.Text('bold', bold = True)
+        doc += p
+    _write(doc, workdir, 'paragraphs.docx')
+
+@benchmark(100000)
+def docx_paragraphs_large(n, backend, workdir):
+    docx_paragraphs(n, backend, workdir)
+
+@benchmark(100000)
+def docx_paragraphs_stream(n, backend, workdir):
+    doc = docx.Document(os.path.join(workdir, 'stream.docx'), 'stream',
+                        backend)
+    for i in range(n):
+        p = docx.Paragraph(docx.Text('Paragraph %i ' % i))
+        p += docx.Text('bold', bold = True)
+        doc += p
+    doc.close()
+
+@benchmark(20000)
+def docx_table(n, backend, workdir):
+    doc = docx.Document(backend = backend)
+    doc += docx.Table(([ i, i * 0.5, 'row %i' % i, 'x' ] for i in range(n)),
+                      caption = 'Large table', header = [ 'a', 'b', 'c', 'd' ],
+                      formats = [ '%i', '%.2f', None, None ])
+    _write(doc, workdir, 'table.docx')
+
+@benchmark(2000)
+def docx_captions(n, backend, workdir):
+    doc = docx.Document(backend = backend)
+    for i in range(n):
+        doc += docx.Table([ [ 'a', 'b' ], [ 1, 2 ] ], caption = 'Table %i' % i)
+    _write(doc, workdir, 'captions.docx')
+
+def _nested_list(depth, width):
+    rows = [ 'Item %i' % i for i in range(width) ]
+    if depth > 1:
+        rows.append([ 'Sublist', docx.List(_nested_list(depth - 1, width)) ])
+    return rows
+
+@benchmark(500)
+def docx_lists(n, backend, workdir):
+    doc = docx.Document(backend = backend)
+    for i in range(n):
+        doc += docx.List(_nested_list(3, 5))
+    _write(doc, workdir, 'lists.docx')
+
+if docx._have_matplotlib:
+    @benchmark(50)
+    def docx_figures(n, backend, workdir):
+        doc = docx.Document(backend = backend)
+        fig = docx.matplotlib.figure.Figure(figsize = (6, 4))
+        for i in range(n):
+            fig.clf()
+            ax = fig.add_subplot(111)
+            ax.plot(range(2000), [ (j * (i + 1)) % 97 for j in range(2000) ])
+            doc += fig
+        _write(doc, workdir, 'figures.docx')
+
+def _template(workdir, n, backend):
+    '''Write a template with n paragraphs, and 100 custom properties that
+    are used in DOCPROPERTY fields of every 100th paragraph.
+    '''
+    fname = os.path.join(workdir, 'template-%i.docx' % n)
+    if os.path.exists(fname):
+        return fname
+    doc = docx.Document(backend = 'etree')
+    x = doc.xml
+    for i in range(n):
+        doc += docx.Paragraph('Paragraph %i with some text' % i)
+        if i % 100 == 0:
+            p = x.children(doc.body)[-1]
+            fld = x.sub(p, 'w:fldSimple', {
+                    'w:instr':' DOCPROPERTY  "P%i"  \\* MERGEFORMAT '
+                    % (i // 100 % 100) })
+            r = x.sub(fld, 'w:r')
+            x.sub(r, 'w:t', text = 'value')
+    props = x.document('Properties', {
+            'xmlns':'http://schemas.openxmlformats.org/officeDocument/2006/custom-properties',
+            'xmlns:vt':docx.ns['vt'] })
+    for i in range(100):
+        prop = x.sub(props, 'property', {
+                'fmtid':'{D5CDD505-2E9C-101B-9397-08002B2CF9AE}',
+                'pid':'%i' % (i + 2), 'name':'P%i' % i })
+        x.sub(prop, 'vt:lpwstr', text = 'value')
+    doc.package['docProps/custom.xml'] = x.tostring(props)
+    doc.writeto(fname)
+    return fname
+
+@benchmark(100000, _template)
+def docx_load(n, backend, template):
+    doc = docx.Document(template, backend = backend)
+    doc.close()
+
+@benchmark(100000, _template)
+def docx_load_write(n, backend, template):
+    doc = docx.Document(template, backend = backend)
+    doc += 'One more paragraph'
+    doc.writeto(template + '.out.docx')
+    doc.close()
+
+@benchmark(10000, _template)
+def docx_properties(n, backend, template):
+    doc = docx.Document(template, backend = backend)
+    for i in range(100):
+        doc.property['P%i' % i] = 'New value %i' % i
+    doc.writeto(template + '.out.docx')
+    doc.close()
+
+@benchmark(100, _template)
+def docx_template_render(n, backend, template):
+    t = docx.Template(template, backend)
+    for i in range(n):
+        t.render(dict(('P%i' % j, 'Value %i' % i) for j in range(100)))
+
+@benchmark(200000)
+def docx_paragraph_objects(n, backend, workdir):
+    return [ docx.Paragraph('row %i' % i) for i in range(n) ]
+
+@benchmark(200000)
+def docx_text_objects(n, backend, workdir):
+    return [ docx.Text('row %i' % i, bold = True) for i in range(n) ]
+
+def _html(backend):
+    return html.Document(None, 'create', backend)
+
+@benchmark(10000)
+def html_paragraphs(n, backend, workdir):
+    doc = _html(backend)
+    for i in range(n):
+        p = html.Paragraph(html.Text('Paragraph %i ' % i))
+        p += html.Text('bold', bold = True)
+        doc += p
+    doc.writeto(os.path.join(workdir, 'paragraphs.html'))
+    doc.close()
+
+@benchmark(20000)
+def html_table(n, backend, workdir):
+    doc = _html(backend)
+    doc += html.Table([ [ i, i * 0.5, 'row %i' % i, 'x' ] for i in range(n) ],
+                      caption = 'Large table')
+    doc.writeto(os.path.join(workdir, 'table.html'))
+    doc.close()
+
+@benchmark(500)
+def html_lists(n, backend, workdir):
+    doc = _html(backend)
+    for i in range(n):
+        rows = [ 'Item %i' % j for j in range(5) ]
+        rows.append(html.List([ 'Sub %i' % j for j in range(5) ]))
+        doc += html.List(rows)
+    doc.writeto(os.path.join(workdir, 'lists.html'))
+    doc.close()
+
+@benchmark(200000)
+def html_paragraph_objects(n, backend, workdir):
+    return [ html.Paragraph('row %i' % i) for i in range(n) ]
+
+def _maxrss():
+    '''Peak resident memory of this process in kB, or None.
+    '''
+    if not _have_resource:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+def run_one(name, scale, backend, workdir, trace = False):
+    '''Run one benchmark in this process and return its measurements.
+    '''
+    for bname, func, size, setup in benchmarks:
+        if bname == name:
+            break
+    else:
+        raise KeyError('Unknown benchmark %s' % name)
+    n = max(1, int(size * scale))
+    arg = setup(workdir, n, backend) if setup is not None else workdir
+    gc.collect()
+    rss = _maxrss()
+    if trace:
+        tracemalloc.start()
+    t = time.time()
+    objects = func(n, backend, arg)
+    t = time.time() - t
+    result = { 'size':n, 'time':t }
+    if trace:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result['peak_alloc_kb'] = peak // 1024
+        if objects is not None:
+            result['bytes_per_object'] = current // len(objects)
+    elif rss is not None:
+        result['peak_rss_kb'] = _maxrss() - rss
+        if objects is not None:
+            result['bytes_per_object'] = (result['peak_rss_kb'] * 1024 
+                                          // len(objects))
+    return result
+
+def _child(name, args, workdir, trace = False):
+    cmd = [ sys.executable, os.path.abspath(__file__), '--child', name,
+            '--scale', repr(args.scale), '--backend', args.backend,
+            '--workdir', workdir ]
+    if trace:
+        cmd.append('--trace')
+    out = subprocess.check_output(cmd)
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+def run(args):
+    '''Run the selected benchmarks, each in its own processes.
+    '''
+    names = args.benchmarks or [ b[0] for b in benchmarks ]
+    workdir = tempfile.mkdtemp(prefix = 'docx-benchmark')
+    results = { }
+    try:
+        for name in names:
+            runs = [ _child(name, args, workdir) for i in range(args.repeat) ]
+            result = {
+                'size':runs[0]['size'],
+                'time':min(r['time'] for r in runs),
+                'times':[ r['time'] for r in runs ],
+                }
+            if runs[0].get('peak_rss_kb') is not None:
+                result['peak_rss_kb'] = max(r['peak_rss_kb'] for r in runs)
+            if runs[0].get('bytes_per_object') is not None:
+                result['bytes_per_object'] = max(r['bytes_per_object'] 
+                                                 for r in runs)
+            if _have_tracemalloc:
+                traced = _child(name, args, workdir, True)
+                result['peak_alloc_kb'] = traced['peak_alloc_kb']
+                if 'bytes_per_object' in traced:
+                    result['bytes_per_object'] = traced['bytes_per_object']
+            results[name] = result
+            _print_result(name, result)
+    finally:
+        shutil.rmtree(workdir)
+    return {
+        'python':platform.python_version(),
+        'implementation':platform.python_implementation(),
+        'platform':platform.platform(),
+        'backend':args.backend,
+        'scale':args.scale,
+        'date':time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results':results,
+        }
+
+def _memory(result):
+    return result.get('peak_alloc_kb', result.get('peak_rss_kb'))
+
+def _print_result(name, result):
+    memory = _memory(result)
+    print('%-24s %8i %10.3f s %12s %s' % (
+            name, result['size'], result['time'],
+            '%i kB' % memory if memory is not None else '-',
+            '(%i B/object)' % result['bytes_per_object']
+            if 'bytes_per_object' in result else ''))
+    sys.stdout.flush()
+
+def compare(report, reference, threshold):
+    '''Print the changes against a reference report, and return the names
+    of the benchmarks that became slower or bigger than threshold allows.
+    '''
+    regressions = [ ]
+    for key in ('python', 'implementation', 'backend', 'scale'):
+        if report.get(key) != reference.get(key):
+            print('Note: the reports differ in %s (%s, reference %s)' 
+                  % (key, report.get(key), reference.get(key)))
+    print('\n%-24s %10s %10s' % ('compared to reference', 'time', 'memory'))
+    for name, result in sorted(report['results'].items()):
+        ref = reference['results'].get(name)
+        if ref is None or ref['size'] != result['size']:
+            print('%-24s %10s %10s' % (name, '-', '-'))
+            continue
+        time_ratio = result['time'] / max(ref['time'], 1e-6)
+        memory_ratio = None
+        for key in ('bytes_per_object', 'peak_alloc_kb', 'peak_rss_kb'):
+            if result.get(key) is not None and ref.get(key) is not None:
+                if ref[key] > 0:
+                    memory_ratio = float(result[key]) / ref[key]
+                break
+        print('%-24s %9.2fx %10s' % (name, time_ratio,
+                                      '%.2fx' % memory_ratio
+                                      if memory_ratio is not None else '-'))
+        if time_ratio > threshold or (memory_ratio or 0) > threshold:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Benchmarks for the docx and html writers.')
+    parser.add_argument('benchmarks', nargs = '*',
+                        help = 'benchmarks to run (default: all)')
+    parser.add_argument('-l', '--list', action = 'store_true',
+                        help = 'list the benchmarks')
+    parser.add_argument('-b', '--backend', default = 'minidom',
+                        help = 'XML backend (default: minidom)')
+    parser.add_argument('-s', '--scale', type = float, default = 1.0,
+                        help = 'factor for all document sizes')
+    parser.add_argument('-r', '--repeat', type = int, default = 3,
+                        help = 'number of timed runs (default: 3)')
+    parser.add_argument('-o', '--output', help = 'write a JSON report')
+    parser.add_argument('-c', '--compare',
+                        help = 'compare with an earlier JSON report')
+    parser.add_argument('-t', '--threshold', type = float, default = 1.2,
+                        help = 'ratio that counts as a regression '
+                        '(default: 1.2)')
+    parser.add_argument('--child', help = argparse.SUPPRESS)
+    parser.add_argument('--workdir', help = argparse.SUPPRESS)
+    parser.add_argument('--trace', action = 'store_true',
+                        help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_one(args.child, args.scale, args.backend,
+                                 args.workdir, args.trace)))
+        return 0
+    if args.list:
+        for name, func, size, setup in benchmarks:
+            print('%-24s %8i' % (name, size))
+        return 0
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent = 2, sort_keys = True)
+    if args.compare:
+        with open(args.compare) as fp:
+            reference = json.load(fp)
+        if compare(report, reference, args.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
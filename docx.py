@@ -10,11 +10,25 @@ I need them :-)
 
 import sys
 import os
-import shutil
-from xml.dom import minidom
+import re
+import io
 import tempfile
 import zipfile
-import codecs
+import zlib
+import time
+import collections
+import itertools
+import multiprocessing
+import uuid
+import hashlib
+import struct
+import functools
+import posixpath
+import pickle
+from xml.sax.saxutils import escape
+
+import xmltree
+import imaging
 
 ns = { 
     'w'  :'http://schemas.openxmlformats.org/wordprocessingml/2006/main',
@@ -25,7 +39,14 @@ ns = {
     'r'  :'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
     'vt' :'http://schemas.openxmlformats.org/officeDocument/2006/docPropsVTypes',
     }
-       
+
+_docproperty_re = re.compile(r'\s*DOCPROPERTY\s+(?:"([^"]*)"|(\S+))')
+
+_relationships = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+
+_image_types = { 'png':'image/png', 'jpg':'image/jpeg', 'jpeg':'image/jpeg',
+                 'gif':'image/gif', 'tif':'image/tiff', 'tiff':'image/tiff',
+                 'bmp':'image/bmp', 'emf':'image/x-emf', 'wmf':'image/x-wmf' }
 
 try:
     import matplotlib.figure
@@ -34,13 +55,664 @@ try:
 except:
     _have_matplotlib = False
 
-def open(fname = None, mode = 'copyonwrite'):
+try:
+    import numpy
+    _have_numpy = True
+except ImportError:
+    _have_numpy = False
+
+try:
+    import concurrent.futures
+    _have_futures = True
+except ImportError:
+    _have_futures = False
+
+try:
+    import asyncio
+    _have_asyncio = True
+except ImportError:
+    _have_asyncio = False
+
+try:
+    unicode
+except NameError:
+    unicode = basestring = str
+
+def open(fname = None, mode = 'copyonwrite', backend = 'minidom',
+         instrument = None):
     '''Create a new (word) document, or load an existing document.
     
     fname: File name
-    mode: Open mode. 'copyonwrite' (default), 'update', 'append' or 'create'.
+    mode: Open mode. 'copyonwrite' (default), 'update', 'append', 'create'
+          or 'stream'.
+    backend: XML tree implementation, 'minidom' (default) or 'etree'.
+    instrument: True or a hook function to enable the instrumentation, see
+                Document.instrument().
+    '''
+    return Document(fname, mode, backend, instrument)
+
+_executor = None
+
+def set_executor(executor):
+    '''Set the executor for the blocking work of the asyncio functions.
+
+    The default is a shared pool of threads, one per CPU. Since all
+    requests share the executor, its size limits how many documents are
+    loaded or written at the same time.
+    '''
+    global _executor
+    _executor = executor
+
+def _run(executor, func, *args):
+    '''Run func in an executor and return an asyncio future for its result.
+    '''
+    global _executor
+    if executor is None:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                multiprocessing.cpu_count())
+        executor = _executor
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(executor, functools.partial(func, *args))
+
+def aopen(fname = None, mode = 'copyonwrite', backend = 'minidom', 
+          executor = None):
+    '''Like open(), but to be awaited in an asyncio event loop:
+
+        doc = await docx.aopen('template.docx')
+
+    The document is loaded in executor (default: see set_executor()).
+    '''
+    return _run(executor, Document, fname, mode, backend)
+
+_w = '{%s}' % ns['w']
+
+def iterparse(fname):
+    '''Read the body of an existing document incrementally.
+
+    The paragraphs and tables of the body are yielded in their order as
+    Paragraph and Table objects. Paragraphs carry their style name and
+    alignment, and consist of Text objects for formatted runs and plain
+    strings for the others. Table cells are Paragraph objects, or lists of
+    Paragraph and Table objects for cells with more content. Other
+    elements (like images or section properties) are skipped.
+
+    word/document.xml is parsed while it is decompressed, and every element
+    is dropped after it was read, so that the memory needed does not grow
+    with the document size.
+    '''
+    zip = zipfile.ZipFile(fname, 'r')
+    try:
+        styles = _style_names(zip)
+        depth = 0
+        body = None
+        for event, el in xmltree.ElementTree.iterparse(
+            zip.open('word/document.xml'), ('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if el.tag == _w + 'body':
+                    body = el
+                continue
+            depth -= 1
+            if depth != 2 or body is None:
+                continue
+            if el.tag == _w + 'p':
+                item = _read_paragraph(el, styles)
+            elif el.tag == _w + 'tbl':
+                item = _read_table(el, styles)
+            else:
+                item = None
+            body.clear()
+            if item is not None:
+                yield item
+    finally:
+        zip.close()
+
+def _style_names(zip):
+    '''Return a mapping of the style ids of a document to their names.
+    '''
+    styles = dict((v, k) for k, v in Document.default_styles.items())
+    if 'word/styles.xml' not in zip.namelist():
+        return styles
+    for event, el in xmltree.ElementTree.iterparse(
+        zip.open('word/styles.xml')):
+        if el.tag == _w + 'style':
+            name = el.find(_w + 'name')
+            if name is not None:
+                styles[el.get(_w + 'styleId')] = name.get(_w + 'val')
+            el.clear()
+    return styles
+
+def _read_switch(rpr, tag):
+    el = rpr.find(_w + tag)
+    if el is None:
+        return None
+    return el.get(_w + 'val') not in ('0', 'false', 'off')
+
+def _read_paragraph(p, styles):
+    ppr = p.find(_w + 'pPr')
+    style = align = None
+    if ppr is not None:
+        el = ppr.find(_w + 'pStyle')
+        if el is not None:
+            style = styles.get(el.get(_w + 'val'), el.get(_w + 'val'))
+        el = ppr.find(_w + 'jc')
+        if el is not None:
+            align = el.get(_w + 'val')
+    par = Paragraph(style = style, align = align)
+    last = None
+    for r in p.iter(_w + 'r'):
+        text = [ ]
+        for el in r:
+            if el.tag == _w + 't':
+                text.append(el.text or u'')
+            elif el.tag == _w + 'tab':
+                text.append(u'\t')
+            elif el.tag in (_w + 'br', _w + 'cr'):
+                text.append(u'\n')
+        if not text:
+            continue
+        text = u''.join(text)
+        rpr = r.find(_w + 'rPr')
+        if rpr is not None:
+            u = rpr.find(_w + 'u')
+            format = (_read_switch(rpr, 'b'), _read_switch(rpr, 'i'),
+                      _underline_codes.get(u.get(_w + 'val'), True) 
+                      if u is not None else None)
+        else:
+            format = (None, None, None)
+        if format == last and par.content:
+            previous = par.content[-1]
+            if isinstance(previous, Text):
+                previous.content += text
+            else:
+                par.content[-1] = previous + text
+        elif format == (None, None, None):
+            par.content.append(text)
+        else:
+            par.content.append(Text(text, *format))
+        last = format
+    return par
+
+def _read_table(tbl, styles):
+    rows = [ ]
+    for tr in tbl.findall(_w + 'tr'):
+        row = [ ]
+        for tc in tr.findall(_w + 'tc'):
+            items = [ ]
+            for el in tc:
+                if el.tag == _w + 'p':
+                    items.append(_read_paragraph(el, styles))
+                elif el.tag == _w + 'tbl':
+                    items.append(_read_table(el, styles))
+            if len(items) == 1 and isinstance(items[0], Paragraph):
+                row.append(items[0])
+            else:
+                row.append(items)
+        rows.append(row)
+    style = tbl.find('%stblPr/%stblStyle' % (_w, _w))
+    return Table(rows, style = style.get(_w + 'val') 
+                 if style is not None else None)
+
+def merge(sources, output, backend = 'etree', pagebreak = False):
+    '''Concatenate documents into one file.
+
+    The first source provides the styles, the headers and the page setup
+    of the result; the bodies of the other sources are appended to it one
+    after the other with Document.appendDocument(). Only one source is
+    parsed at a time.
     '''
-    return Document(fname, mode)
+    sources = iter(sources)
+    doc = Document(next(sources), 'copyonwrite', backend)
+    for source in sources:
+        doc.appendDocument(source, pagebreak)
+    doc.writeto(output)
+    doc.close()
+
+def render_many(template, records, output = None, workers = None, 
+                chunksize = 1):
+    '''Generate many documents in a pool of worker processes.
+
+    template: Template file name or Template, to be filled with the custom
+              property values given by each record; or a function that
+              takes a record and returns a Document. The function must be
+              defined at module level, so that it can be sent to the worker
+              processes.
+    records: Iterable of records (property dictionaries for templates).
+    output: Output file name pattern, which is formatted with the index of
+            the record (like 'report-%05i.docx'), or a function that takes
+            the index and the record and returns the file name. If None,
+            the documents are returned as byte strings.
+    workers: Number of worker processes. Defaults to the number of CPUs.
+    chunksize: Number of records that are sent to a worker at once.
+
+    For every record, a tuple (result, error) is yielded in the order of
+    the records. result is the file name or the document bytes, or None if
+    the generation failed with the exception error.
+
+    Without the concurrent.futures module, or with workers = 1, the
+    documents are generated in the calling process.
+    '''
+    job = (template, output)
+    chunks = _chunked(enumerate(records), chunksize)
+    if not _have_futures or workers == 1:
+        for chunk in chunks:
+            for result in _render_chunk(job, chunk):
+                yield result
+        return
+    workers = workers or multiprocessing.cpu_count()
+    executor = concurrent.futures.ProcessPoolExecutor(workers)
+    pending = collections.deque()
+    try:
+        for chunk in chunks:
+            pending.append((len(chunk), 
+                            executor.submit(_render_chunk, job, chunk)))
+            if len(pending) > 2 * workers:
+                for result in _chunk_results(*pending.popleft()):
+                    yield result
+        while pending:
+            for result in _chunk_results(*pending.popleft()):
+                yield result
+    finally:
+        executor.shutdown()
+
+def _chunked(iterable, size):
+    chunk = [ ]
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = [ ]
+    if chunk:
+        yield chunk
+
+def _chunk_results(size, future):
+    try:
+        return future.result()
+    except Exception as e:
+        return [ (None, e) ] * size
+
+_templates = { }
+
+def _render_chunk(job, chunk):
+    template, output = job
+    if not isinstance(template, Template) and not callable(template):
+        if template not in _templates:
+            _templates[template] = Template(template)
+        template = _templates[template]
+    results = [ ]
+    for i, record in chunk:
+        try:
+            if output is None:
+                fname = io.BytesIO()
+            elif callable(output):
+                fname = output(i, record)
+            else:
+                fname = output % i
+            if isinstance(template, Template):
+                template.render(record, fname)
+            else:
+                template(record).writeto(fname)
+            if output is None:
+                fname = fname.getvalue()
+            results.append((fname, None))
+        except Exception as e:
+            results.append((None, e))
+    return results
+
+class _ZipStream(object):
+    '''Writable file object that deflates directly into a new entry of an
+    open zip file.
+
+    Nothing else may be written to the zip file until the stream is closed.
+    '''
+    def __init__(self, zip, name):
+        self.zip = zip
+        self.zinfo = zipfile.ZipInfo(name, time.localtime()[:6])
+        self.zinfo.compress_type = zipfile.ZIP_DEFLATED
+        self.zinfo.external_attr = 0o600 << 16
+        self.zinfo.file_size = 0
+        self.zinfo.compress_size = 0
+        self.zinfo.CRC = 0
+        self.zinfo.header_offset = zip.fp.tell()
+        zip.fp.write(self.zinfo.FileHeader(False))
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                           zlib.DEFLATED, -15)
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.zinfo.file_size += len(data)
+        self.zinfo.CRC = zlib.crc32(data, self.zinfo.CRC) & 0xffffffff
+        data = self.compressor.compress(data)
+        self.zinfo.compress_size += len(data)
+        self.zip.fp.write(data)
+
+    def close(self):
+        data = self.compressor.flush()
+        self.zinfo.compress_size += len(data)
+        self.zip.fp.write(data)
+        # Rewrite the header, now with the correct CRC and sizes
+        position = self.zip.fp.tell()
+        self.zip.fp.seek(self.zinfo.header_offset)
+        self.zip.fp.write(self.zinfo.FileHeader(False))
+        self.zip.fp.seek(position)
+        _add_zipinfo(self.zip, self.zinfo)
+
+def _add_zipinfo(zip, zinfo):
+    '''Register an entry that was written directly into an open zip file.
+    '''
+    zip.filelist.append(zinfo)
+    zip.NameToInfo[zinfo.filename] = zinfo
+    zip._didModify = True
+    if hasattr(zip, 'start_dir'):
+        zip.start_dir = zip.fp.tell()
+
+# Parts with these extensions are compressed already and stored as they are
+_stored_extensions = frozenset([ 'png', 'jpg', 'jpeg', 'jpe', 'gif', 'tif', 
+                                 'tiff', 'emz', 'wmz', 'wdp', 'zip' ])
+
+def _compress_type(name):
+    '''Return the zip compression type for a part.
+    '''
+    if name.rsplit('.', 1)[-1].lower() in _stored_extensions:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def _compress(data, compress_type, level):
+    '''Return the CRC and the compressed data of a part.
+    '''
+    crc = zlib.crc32(data) & 0xffffffff
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+    return crc, data
+
+def _write_compressed(zip, name, size, crc, data, compress_type):
+    '''Write an entry with already compressed data into an open zip file.
+    '''
+    zinfo = zipfile.ZipInfo(name, time.localtime()[:6])
+    zinfo.compress_type = compress_type
+    zinfo.external_attr = 0o600 << 16
+    zinfo.file_size = size
+    zinfo.compress_size = len(data)
+    zinfo.CRC = crc
+    zinfo.header_offset = zip.fp.tell()
+    zip.fp.write(zinfo.FileHeader(False))
+    zip.fp.write(data)
+    _add_zipinfo(zip, zinfo)
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+class _Phase(object):
+    def __init__(self, stats, name, item):
+        self.stats = stats
+        self.name = name
+        self.item = item
+
+    def __enter__(self):
+        self.outer = self.stats._item
+        if self.item is not None:
+            self.stats._item = self.item
+        self.start = _clock()
+
+    def __exit__(self, *exc):
+        self.stats.add(self.name, _clock() - self.start, self.item)
+        self.stats._item = self.outer
+
+class Instrumentation(object):
+    '''Timers and counters of a document, see Document.instrument().
+
+    times: Seconds spent per phase: 'load', 'parse', 'append', 'fields',
+           'media', 'serialize' and 'zip'. Phases may be nested: 'load'
+           includes parsing document.xml, 'append' may include
+           serialization in 'stream' mode.
+    calls: Number of timed calls per phase.
+    objects: Number of appended content objects, by class name.
+    elements: Number of XML elements created, by the class name of the
+              content object that created them (None for other elements).
+    parts: Bytes written per package part, as (size, compressed size).
+
+    Every hook is called as hook(event, name, value) for the events
+    'phase' (with the seconds of one call) and 'part' (with the sizes).
+    '''
+    def __init__(self):
+        self.times = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.objects = collections.defaultdict(int)
+        self.elements = collections.defaultdict(int)
+        self.parts = { }
+        self.hooks = [ ]
+        self._item = None
+
+    def phase(self, name, item = None):
+        '''Context manager that times a phase. item is the content object
+        that is appended.
+        '''
+        if item is not None:
+            item = type(item).__name__
+            self.objects[item] += 1
+        return _Phase(self, name, item)
+
+    def add(self, name, seconds, item = None):
+        self.times[name] += seconds
+        self.calls[name] += 1
+        if item is not None:
+            self.times['%s %s' % (name, item)] += seconds
+        for hook in self.hooks:
+            hook('phase', name, seconds)
+
+    def element(self):
+        self.elements[self._item] += 1
+
+    def part(self, name, size, compressed):
+        self.parts[name] = (size, compressed)
+        for hook in self.hooks:
+            hook('part', name, (size, compressed))
+
+    def summary(self):
+        '''Return a table of all timers and counters.
+        '''
+        lines = [ '%-32s %8s %10s' % ('phase', 'calls', 'seconds') ]
+        for name, t in sorted(self.times.items()):
+            lines.append('%-32s %8s %10.3f' % (name, self.calls.get(name, ''),
+                                               t))
+        lines.append('')
+        lines.append('%-32s %8s %10s' % ('content', 'objects', 'elements'))
+        for name in sorted(set(self.objects) | set(self.elements), 
+                           key = str):
+            lines.append('%-32s %8i %10i' % (name or '(other)', 
+                                             self.objects.get(name, 0),
+                                             self.elements.get(name, 0)))
+        lines.append('')
+        lines.append('%-32s %8s %10s' % ('part', 'bytes', 'compressed'))
+        for name, (size, compressed) in sorted(self.parts.items()):
+            lines.append('%-32s %8i %10i' % (name, size, compressed))
+        return '\n'.join(lines)
+
+class _NoInstrumentation(object):
+    '''Instrumentation that does nothing, used when it is disabled.
+    '''
+    def phase(self, name, item = None):
+        return self
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+    def part(self, name, size, compressed):
+        pass
+
+_noinstrumentation = _NoInstrumentation()
+
+class _lazy(object):
+    '''Attribute that is computed on its first access.
+
+    The value is then stored in the instance and replaces the attribute.
+    '''
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.__name__] = self.func(obj)
+        return value
+
+class Package(object):
+    '''Parts of an OOXML (zip) package.
+
+    A part is either a reference into the source zip file, which is read
+    only when needed, or in-memory data. Nothing is extracted to disk.
+
+    When the package is written, parts that are still unchanged references
+    are copied from the source file without decompressing them. Of the
+    other parts, already compressed media are stored and the rest is
+    deflated with compresslevel. Parts of at least parallel_size bytes are
+    compressed in a pool of threads.
+    '''
+    compresslevel = zlib.Z_DEFAULT_COMPRESSION
+    parallel_size = 1 << 18
+    stats = _noinstrumentation
+
+    def __init__(self, fname = None):
+        self.fname = fname
+        self.parts = { }
+        self._zip = None
+        if fname is not None:
+            for name in self.zip.namelist():
+                self.parts[name] = None
+
+    @property
+    def zip(self):
+        if self._zip is None:
+            self._zip = zipfile.ZipFile(self.fname, 'r')
+        return self._zip
+
+    def __contains__(self, name):
+        return name in self.parts
+
+    def __iter__(self):
+        return iter(self.parts)
+
+    def __getitem__(self, name):
+        data = self.parts[name]
+        if data is None:
+            data = self.zip.read(name)
+        return data
+
+    def __setitem__(self, name, data):
+        self.parts[name] = data
+
+    def open(self, name):
+        '''Open a part for reading.
+        '''
+        data = self.parts[name]
+        if data is None:
+            return self.zip.open(name)
+        return io.BytesIO(data)
+
+    def raw(self, name):
+        '''Return the size, the CRC, the compressed data and the compression
+        type of an unchanged part of the source file, or None.
+        '''
+        if self.parts[name] is not None:
+            return None
+        zinfo = self.zip.getinfo(name)
+        if (zinfo.flag_bits & 0x1 or zinfo.compress_type not in 
+            (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)):
+            return None
+        fp = self.zip.fp
+        fp.seek(zinfo.header_offset)
+        header = struct.unpack(zipfile.structFileHeader, 
+                               fp.read(zipfile.sizeFileHeader))
+        fp.seek(header[zipfile._FH_FILENAME_LENGTH] 
+                + header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+        return (zinfo.file_size, zinfo.CRC, fp.read(zinfo.compress_size),
+                zinfo.compress_type)
+
+    def compressed(self, name, compresslevel = None):
+        '''Return the size, the CRC, the compressed data and the compression
+        type of a part.
+        '''
+        raw = self.raw(name)
+        if raw is not None:
+            return raw
+        if compresslevel is None:
+            compresslevel = self.compresslevel
+        data = self[name]
+        compress_type = _compress_type(name)
+        crc, cdata = _compress(data, compress_type, compresslevel)
+        return len(data), crc, cdata, compress_type
+
+    def writeto(self, zip, compresslevel = None):
+        '''Write all parts into an open zip file.
+        '''
+        if compresslevel is None:
+            compresslevel = self.compresslevel
+        executor = None
+        pending = [ ]
+        for name in self.parts:
+            raw = self.raw(name)
+            if raw is not None:
+                _write_compressed(zip, name, *raw)
+                self.stats.part(name, raw[0], len(raw[2]))
+                continue
+            data = self[name]
+            compress_type = _compress_type(name)
+            if (_have_futures and compress_type == zipfile.ZIP_DEFLATED 
+                and len(data) >= self.parallel_size):
+                if executor is None:
+                    executor = concurrent.futures.ThreadPoolExecutor(
+                        multiprocessing.cpu_count())
+                pending.append((name, len(data), compress_type, 
+                                executor.submit(_compress, data, 
+                                                compress_type, 
+                                                compresslevel)))
+            else:
+                crc, cdata = _compress(data, compress_type, compresslevel)
+                _write_compressed(zip, name, len(data), crc, cdata, 
+                                  compress_type)
+                self.stats.part(name, len(data), len(cdata))
+        for name, size, compress_type, future in pending:
+            crc, cdata = future.result()
+            _write_compressed(zip, name, size, crc, cdata, compress_type)
+            self.stats.part(name, size, len(cdata))
+        if executor is not None:
+            executor.shutdown()
+
+    def save(self, filename, compresslevel = None):
+        '''Save the package as a zip file.
+
+        filename may also be a writable file object. If the file is the
+        source of the package, a new file is written and then moved over
+        the source.
+        '''
+        if (self.fname is not None and not hasattr(filename, 'write') and
+            os.path.abspath(filename) == os.path.abspath(self.fname)):
+            fd, tmpname = tempfile.mkstemp(dir = os.path.dirname(filename) 
+                                           or '.', suffix = '.docx')
+            os.close(fd)
+            self._save(tmpname, compresslevel)
+            os.chmod(tmpname, os.stat(filename).st_mode & 0o777)
+            self.close()
+            os.rename(tmpname, filename)
+        else:
+            self._save(filename, compresslevel)
+
+    def _save(self, filename, compresslevel):
+        f = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED)
+        self.writeto(f, compresslevel)
+        f.close()
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
 
 class CustomProperty(object):
     '''Field of user settable properties.
@@ -48,252 +720,592 @@ class CustomProperty(object):
     These properties may be used to fill defined fields of a document with
     custom values. Examples are the author, the document title, or a document
     id.
+
+    Several properties are best set at once with update(). The locations
+    of the DOCPROPERTY fields in the body, the headers and the footers are
+    collected once, when the first property is set, so that later updates
+    replace the fields directly.
     '''
     def __init__(self, parent, pfile = None):
         self.parent = parent
+        self.xml = parent.xml
         if pfile is not None:
-            self.doc = minidom.parse(pfile)
+            self.doc = self.xml.parse(pfile)
         else:
-            self.doc = minidom.Document()
-            p = self.doc.createElement('Properties')
-            p.setAttribute('xmlns', 'http://schemas.openxmlformats.org/officeDocument/2006/custom-properties')
-            p.setAttribute('xmlns:vt', ns['vt'])
-            self.doc.appendChild(p)
+            self.doc = self.xml.document('Properties', {
+                    'xmlns':'http://schemas.openxmlformats.org/officeDocument/2006/custom-properties',
+                    'xmlns:vt':ns['vt'] })
+        self._index = { }
+        self._max_pid = 1
+        for n in self.xml.iter(self.doc, 'property'):
+            self._max_pid = max(self._max_pid, int(self.xml.get(n, 'pid')))
+            self._index.setdefault(self.xml.get(n, 'name'), n)
             
-    def _get_TextNode(self, key, create = False):
-        max_pid = 1
-        for n in self.doc.getElementsByTagName('property'):
-            max_pid = max(max_pid, int(n.getAttribute('pid')))
-            if n.getAttribute('name') == key:
-                break
-        else:
-            if create:
-                n = self.doc.createElement('property')
-                n.setAttribute('name', key)
-                n.setAttribute('pid', '%i' % (max_pid+1))
-                self.doc.documentElement.appendChild(n)
-            else:
+    def _get_value(self, key, create = False):
+        x = self.xml
+        n = self._index.get(key)
+        if n is None:
+            if not create:
                 return None
-        vl = n.getElementsByTagName('vt:lpwstr')
+            self._max_pid += 1
+            n = x.sub(self.doc, 'property', 
+                      { 'name':key, 'pid':'%i' % self._max_pid })
+            self._index[key] = n
+        vl = x.iter(n, 'vt:lpwstr')
         if len(vl) > 0:
-            v = vl[0]
-        else:
-            v = self.doc.createElement('vt:lpwstr')
-            n.appendChild(v)
-        for t in v.childNodes:
-            if t.nodeType == v.TEXT_NODE:
-                break
-        else:
-            t = self.doc.createTextNode('')
-            v.appendChild(t)
-        return t
+            return vl[0]
+        return x.sub(n, 'vt:lpwstr', text = '')
 
-    def _update_field(self, element, key, value):
-        instr = ' DOCPROPERTY  "%s"  \\* MERGEFORMAT ' % key
-        # Replace "Simple" properties
-        for n in element.getElementsByTagName('w:fldSimple'):
-            if n.getAttribute('w:instr').strip() != instr.strip():
-                continue
-            wp = n.parentNode
-            nwr = wp.ownerDocument.createElement('w:r')
-            flds = nwr.ownerDocument.createElement('w:fldSimple')
-            flds.setAttribute('w:instr', instr)
-            wr = n.getElementsByTagName('w:r')
-            if len(wr) > 0:
-                for rpr in wr[0].getElementsByTagName('w:rPr'):
-                    wr[0].removeChild(rpr)
-                    flds.appendChild(rpr)
-            wt = flds.ownerDocument.createElement('w:t')
-            wt.appendChild(wp.ownerDocument.createTextNode(value))
-            nwr.appendChild(wt)
-            flds.appendChild(nwr)
-            wp.replaceChild(flds, n)
-
-        # Replace "Complex" properties.
-        for n in element.getElementsByTagName('w:instrText'):
-            if n.firstChild is None:
-                continue
-            if n.firstChild.data.strip() != instr.strip():
-                continue
-            wr = n.parentNode
-            wp = wr.parentNode
-            wrs = []
-            wr0 = wr.previousSibling
-            while wr0 is not None:
-                wrs.append(wr0)
-                if wr0.nodeType == wr0.ELEMENT_NODE:
-                    flds = wr0.getElementsByTagName('w:fldChar')
-                    if len(flds) > 0:
-                        break
-                wr0 = wr0.previousSibling
-            wr0 = wr.nextSibling
-            while wr0 is not None:
-                wrs.append(wr0)
-                if wr0.nodeType == wr0.ELEMENT_NODE:
-                    flds = wr0.getElementsByTagName('w:fldChar')
-                    if len(flds) > 0:
-                        if flds[0].getAttribute('w:fldCharType') == 'end':
+    @staticmethod
+    def _field_name(instr):
+        '''Return the property name of a DOCPROPERTY field instruction, or
+        None for other fields.
+        '''
+        m = _docproperty_re.match(instr)
+        if m is not None:
+            return m.group(1) if m.group(1) is not None else m.group(2)
+
+    def invalidate(self):
+        '''Collect the locations of the fields again on the next update,
+        after fields were added to the body.
+        '''
+        self.__dict__.pop('_fields', None)
+
+    @_lazy
+    def _fields(self):
+        '''Locations of the DOCPROPERTY fields, by property name.
+
+        Each location is a pair of the parent and the field element (a
+        fldSimple element, or the run with the instrText of a complex field).
+        '''
+        x = self.xml
+        fields = { }
+        for root in [ self.parent.body ] + list(self.parent.headers.values()):
+            parents = x.parents(root)
+            for n in x.iter(root, '*'):
+                tag = x.tag(n)
+                if tag == 'w:fldSimple':
+                    key = self._field_name(x.get(n, 'w:instr'))
+                elif tag == 'w:instrText':
+                    key = self._field_name(x.text(n))
+                    n = parents[n]
+                else:
+                    continue
+                if key is not None:
+                    fields.setdefault(key, []).append([parents[n], n])
+        return fields
+
+    def _update_fields(self, values):
+        x = self.xml
+        for key, value in values.items():
+            for location in self._fields.get(key, ()):
+                wp, n = location
+                if x.tag(n) == 'w:fldSimple':
+                    # Replace "Simple" property
+                    wr = x.iter(n, 'w:r')
+                    rpr = x.iter(wr[0], 'w:rPr') if len(wr) > 0 else []
+                else:
+                    # Replace "Complex" property
+                    siblings = x.children(wp)
+                    i = siblings.index(n)
+                    wrs = []
+                    for wr0 in reversed(siblings[:i]):
+                        wrs.append(wr0)
+                        if len(x.iter(wr0, 'w:fldChar')) > 0:
                             break
-                wr0 = wr0.nextSibling
-            for wr0 in wrs:
-                wp.removeChild(wr0)
-                wr0.unlink()
-            nwr = wp.ownerDocument.createElement('w:r')
-            flds = nwr.ownerDocument.createElement('w:fldSimple')
-            flds.setAttribute('w:instr', instr)
-            for rpr in wr.getElementsByTagName('w:rPr'):
-                wr.removeChild(rpr)
-                flds.appendChild(rpr)
-            
-            wt = flds.ownerDocument.createElement('w:t')
-            wt.appendChild(wp.ownerDocument.createTextNode(value))
-            nwr.appendChild(wt)
-            flds.appendChild(nwr)
-            wp.replaceChild(flds, wr)
-                    
+                    for wr0 in siblings[i+1:]:
+                        wrs.append(wr0)
+                        flds = x.iter(wr0, 'w:fldChar')
+                        if len(flds) > 0:
+                            if x.get(flds[0], 'w:fldCharType') == 'end':
+                                break
+                    for wr0 in wrs:
+                        x.remove(wp, wr0)
+                    rpr = x.iter(n, 'w:rPr')
+                location[1] = self._new_field(n, key, value, rpr)
+                x.replace(wp, location[1], n)
+
+    def _new_field(self, ref, key, value, rpr):
+        '''Create a simple field element with the value as its result.
+        '''
+        x = self.xml
+        instr = ' DOCPROPERTY  "%s"  \\* MERGEFORMAT ' % key
+        flds = x.create(ref, 'w:fldSimple', { 'w:instr':instr })
+        nwr = x.sub(flds, 'w:r')
+        for r in list(rpr):
+            x.append(nwr, r)
+        x.sub(nwr, 'w:t', text = value)
+        return flds
+
+    def update(self, values):
+        '''Set several properties at once.
+
+        values is a dictionary (or a sequence of key/value pairs).
+        '''
+        values = dict(values)
+        with self.parent.stats.phase('fields'):
+            for key, value in values.items():
+                self.xml.set_text(self._get_value(key, True), value)
+            self._update_fields(values)
+        if self.parent._index is not None:
+            self.parent._index.invalidate()
+
     def __getitem__(self, key):
-        v = self._get_TextNode(key)
-        return v.data or None
+        v = self._get_value(key)
+        if v is None:
+            raise KeyError(key)
+        return self.xml.text(v) or None
 
     def __setitem__(self, key, value):
-        self._get_TextNode(key, True).data = value
-        self._update_field(self.parent.body, key, value)
-        self._update_field(self.parent.header.documentElement, key, value)
+        self.update({ key:value })
+
+    def __contains__(self, key):
+        return key in self._index
 
     def __iter__(self):
-        return iter(n.getAttribute('name') 
-                    for n in self.doc.getElementsByTagName('property'))
+        return iter(self.xml.get(n, 'name') 
+                    for n in self.xml.iter(self.doc, 'property'))
 
 class Settings(object):
     '''XML tree containing all document settings.
     '''
-    def __init__(self, sfile = None):
+    def __init__(self, xml, sfile = None):
         if sfile is not None:
-            self.doc = minidom.parse(sfile)
+            self.doc = xml.parse(sfile)
         else:
-            self.doc = minicom.Document()
-            p = self.doc.createElement('w:settings')
-            p.setAttribute('xmlns:w', ns['w'])
-            self.doc.appendChild(p)
+            self.doc = xml.document('w:settings', { 'xmlns:w':ns['w'] })
+
+IndexEntry = collections.namedtuple('IndexEntry', 
+                                    'position kind style text element')
+
+class Index(object):
+    '''Search index over the paragraphs and tables of a document body.
+
+    Every paragraph and table becomes an IndexEntry with its position among
+    them, its kind ('paragraph', 'caption' or 'table'), its style name, its
+    text, and its element. Use Document.index() to get the index of a
+    document; it is updated when content is appended to the document.
+
+    The index remembers the last element of the body. When that element
+    has been removed or moved (for example because elements before it
+    were removed), the index is rebuilt on the next update or lookup.
+    Changes within elements, or removals before the last element that are
+    balanced by insertions, need an explicit invalidate().
+    '''
+    def __init__(self, doc):
+        self.doc = doc
+        self.invalidate()
+
+    def invalidate(self):
+        '''Rebuild the index on the next lookup.
+        '''
+        self._position = None
+
+    def _rebuild(self):
+        self.entries = [ ]
+        self.styles = { }
+        self.kinds = { }
+        self.words = { }
+        self._position = -1
+        self._last = None
+        self._style_names = dict((v, k) for k, v in self.doc.styles.items())
+        self.update()
+
+    def _valid(self):
+        '''Whether the last indexed element is still in its place.
+        '''
+        if self._position is None:
+            return False
+        if self._last is None:
+            return True
+        el = self.doc.xml.children(self.doc.body, self._position)[:1]
+        return bool(el) and el[0] is self._last
+
+    def _tail(self):
+        '''Return the position and the last element of the body.
+        '''
+        x = self.doc.xml
+        i = x.count(self.doc.body)
+        while i > 0:
+            i -= 1
+            el = x.children(self.doc.body, i)
+            if el:
+                return i, el[0]
+        return -1, None
+
+    def update(self):
+        '''Add the elements that were appended to the body since the last
+        update, or rebuild the index if elements were removed.
+        '''
+        if self._position is None:
+            return
+        if not self._valid():
+            self._rebuild()
+            return
+        x = self.doc.xml
+        new = x.children(self.doc.body, self._position + 1)
+        if new:
+            self._position, self._last = self._tail()
+        for el in new:
+            tag = x.tag(el)
+            if tag == 'w:p':
+                self._add(el, self._paragraph_kind(el), self._style(el, 
+                          'w:pStyle'), self._text(el))
+            elif tag == 'w:tbl':
+                self._add(el, 'table', self._style(el, 'w:tblStyle'),
+                          u'\n'.join(u'\t'.join(self._text(tc) 
+                                                  for tc in x.iter(tr, 'w:tc'))
+                                       for tr in x.iter(el, 'w:tr')))
+
+    def _add(self, el, kind, style, text):
+        entry = IndexEntry(len(self.entries), kind, style, text, el)
+        self.entries.append(entry)
+        self.kinds.setdefault(kind, [ ]).append(entry)
+        self.styles.setdefault(style, [ ]).append(entry)
+        for word in set(re.findall(r'\w+', text.lower(), re.UNICODE)):
+            self.words.setdefault(word, [ ]).append(entry)
+
+    def _paragraph_kind(self, el):
+        x = self.doc.xml
+        instrs = [ x.get(n, 'w:instr') for n in x.iter(el, 'w:fldSimple') ]
+        instrs += [ x.text(n) for n in x.iter(el, 'w:instrText') ]
+        for instr in instrs:
+            if instr.split()[:1] == [ 'SEQ' ]:
+                return 'caption'
+        return 'paragraph'
+
+    def _style(self, el, tag):
+        styles = self.doc.xml.iter(el, tag)
+        if not styles:
+            return None
+        style = self.doc.xml.get(styles[0], 'w:val')
+        return self._style_names.get(style, style)
+
+    def _text(self, el):
+        x = self.doc.xml
+        return u''.join(x.text(t) for t in x.iter(el, 'w:t'))
+
+    def _current(self):
+        if not self._valid():
+            self._rebuild()
+        return self
+
+    def __len__(self):
+        return len(self._current().entries)
+
+    def __iter__(self):
+        return iter(self._current().entries)
+
+    def with_style(self, style):
+        '''Return the entries with a style name.
+        '''
+        return list(self._current().styles.get(style, ()))
+
+    def of_kind(self, kind):
+        '''Return the entries of a kind: 'paragraph', 'caption' or 'table'.
+        '''
+        return list(self._current().kinds.get(kind, ()))
+
+    def find(self, phrase):
+        '''Return the entries that contain a phrase.
+
+        The phrase is matched as whole words, ignoring the case and the
+        kind of white space and punctuation between the words.
+        '''
+        words = re.findall(r'\w+', phrase.lower(), re.UNICODE)
+        if not words:
+            return [ ]
+        candidates = None
+        for word in set(words):
+            entries = self._current().words.get(word, ())
+            if candidates is None or len(entries) < len(candidates):
+                candidates = entries
+        pattern = re.compile(r'(?<!\w)%s(?!\w)' % r'\W+'.join(
+                re.escape(w) for w in words), re.IGNORECASE | re.UNICODE)
+        return [ e for e in candidates if pattern.search(e.text) ]
 
 class Document(object):
     '''Main document.
 
     This contains the main document as well as all necessary subdocuments.
+    When an existing document is loaded, the subdocuments (styles, property,
+    settings, header, numberings) are parsed only when they are first used.
     '''
-    def __init__(self, fname = None, mode = 'copyonwrite'):
+
+    default_styles = { 'heading 1':'berschrift1', 'heading 2':'berschrift2', 
+                       'heading 3':'berschrift3', 'heading 4':'berschrift4',
+                       'heading 5':'berschrift5', 'heading 6':'berschrift6',
+                       'heading 7':'berschrift7', 'heading 8':'berschrift8',
+                       'caption':'Beschriftung', 'Normal':'Standard' }
+
+    def __init__(self, fname = None, mode = 'copyonwrite', 
+                 backend = 'minidom', instrument = None):
         '''Create a new (word) document, or load an existing document.
 
         fname: File name
-        mode: Open mode. 'copyonwrite' (default), 'update', 'append' or 
-              'create'.
+        mode: Open mode. 'copyonwrite' (default), 'update', 'append', 
+              'create' or 'stream'.
+        backend: XML tree implementation, 'minidom' (default) or 'etree'.
+        instrument: True or a hook function to enable the instrumentation
+                    from the start, see instrument().
+
+        In 'stream' mode, a new document is created and every appended
+        element is serialized directly into the file and then dropped, so
+        that the memory usage does not grow with the document size. The
+        document is completed by close().
         '''
         self.fname = fname
         self.mode = mode
-        self.tmpdir = tempfile.mkdtemp(prefix = 'word')
-        worddir = os.path.join(self.tmpdir, 'word')
-        self.mediadir = os.path.join(worddir, 'media')
-        os.mkdir(worddir)
-        os.mkdir(self.mediadir)
-        os.mkdir(os.path.join(self.tmpdir, 'docProps'))
-        os.mkdir(os.path.join(self.tmpdir, '_rels'))
-        os.mkdir(os.path.join(worddir, '_rels'))
+        self.xml = xmltree.get(backend)
+        self.stats = _noinstrumentation
+        self._stream = None
+        self.package = Package()
+        if instrument:
+            self.instrument(None if instrument is True else instrument)
         self.media = { }
-        self.styles = { 'heading 1':'berschrift1', 'heading 2':'berschrift2', 
-                        'heading 3':'berschrift3', 'heading 4':'berschrift4',
-                        'heading 5':'berschrift5', 'heading 6':'berschrift6',
-                        'heading 7':'berschrift7', 'heading 8':'berschrift8',
-                        'caption':'Beschriftung', 'Normal':'Standard' }
-        if fname is None or mode is 'create':
+        self._external = set()
+        self.images = imaging.ImageOptions()
+        self._pending = collections.OrderedDict()
+        self._executor = None
+        self._fragments = { }
+        self._index = None
+        if mode == 'stream':
+            if fname is None:
+                raise IOError('stream mode requires a file name')
+            self._createdefault()
+            self._openstream(fname)
+        elif fname is None or mode == 'create':
             self._createdefault()
         elif os.path.exists(fname):
-            self._load(fname)
-        elif mode is 'create' or mode is 'append':
+            with self.stats.phase('load'):
+                self._load(fname)
+        elif mode == 'create' or mode == 'append':
             self._createdefault()
         else:
             raise IOError('%s does not exist' % fname)
 
+    def instrument(self, hook = None):
+        '''Enable the instrumentation and return its Instrumentation object.
+
+        hook is added to the hooks of the instrumentation. Without
+        instrumentation, the timers cost only a no-op call per appended
+        object and per written part.
+        '''
+        if self.stats is _noinstrumentation:
+            self.stats = Instrumentation()
+            self.xml = xmltree.Instrumented(self.xml, self.stats)
+        self.package.stats = self.stats
+        if hook is not None:
+            self.stats.hooks.append(hook)
+        return self.stats
+
+    def _openstream(self, fname):
+        self._zip = zipfile.ZipFile(fname, 'w', zipfile.ZIP_DEFLATED)
+        self._stream = _ZipStream(self._zip, 'word/document.xml')
+        self.xml.set_text(self.body, '@@body@@')
+        head, tail = self.xml.tostring(self._root).split(b'@@body@@')
+        self.xml.set_text(self.body, '')
+        self._stream.write(head)
+        self._streamtail = tail
+
+    def _drain(self):
+        '''Serialize all elements of the body into the stream and drop them.
+        '''
+        self._stream_children(self.body)
+
+    def _stream_open(self, el):
+        '''Write the start tag and the current children of el, which must be
+        the last element of the body, to the stream.
+
+        Children that are appended later are written by _stream_children().
+        The returned end tag must be written after the last child.
+        '''
+        x = self.xml
+        x.remove(self.body, el)
+        self._drain()
+        children = x.children(el)
+        for c in children:
+            x.remove(el, c)
+        x.set_text(el, '@@open@@')
+        head, tail = x.fragment(el).split(b'@@open@@')
+        x.set_text(el, '')
+        self._stream.write(head)
+        for c in children:
+            x.append(el, c)
+        self._stream_children(el)
+        return tail
+
+    def _stream_children(self, el):
+        '''Write all children of el to the stream and drop them.
+        '''
+        x = self.xml
+        for n in x.children(el):
+            x.remove(el, n)
+            self._stream.write(x.fragment(n))
+            x.release(n)
+
+    def _closestream(self):
+        self._drain()
+        self._join_media()
+        self._stream.write(self._streamtail)
+        self._stream.close()
+        zinfo = self._stream.zinfo
+        self.stats.part(zinfo.filename, zinfo.file_size, zinfo.compress_size)
+        self._stream = None
+        self._writeparts()
+        with self.stats.phase('zip'):
+            self.package.writeto(self._zip)
+            self._zip.close()
+
     def _createdefault(self):
-        doc = minidom.Document()
-        wdoc = doc.createElement('w:document')
-        wdoc.setAttribute('xmlns:w', ns['w'])
-        wdoc.setAttribute('xmlns:wx', ns['wx'])
-        wdoc.setAttribute('xmlns:wp', ns['wp'])
-        wdoc.setAttribute('xmlns:a', ns['a'])
-        wdoc.setAttribute('xmlns:r', ns['r'])
-        doc.appendChild(wdoc)
-        self.body = doc.createElement('w:body')
-        wdoc.appendChild(self.body)
-        relations = minidom.Document()
-        relsElem = relations.createElement("Relationships")
-        relsElem.setAttribute("xmlns", "http://schemas.openxmlformats.org/package/2006/relationships")
-        relations.appendChild(relsElem)
-        relshipElem = relations.createElement("Relationship")
-        relshipElem.setAttribute("Id", "myrId1")
-        relshipElem.setAttribute("Type", "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument")
-        relshipElem.setAttribute("Target", "word/document.xml")
-        relsElem.appendChild(relshipElem)
-        self._xmlwrite(relations, os.path.join('_rels', '.rels'))
-        content = minidom.Document()
-        cTypes = content.createElement('Types')
-        cTypes.setAttribute('xmlns', 'http://schemas.openxmlformats.org/package/2006/content-types')
+        x = self.xml
+        self._root = x.document('w:document', {
+                'xmlns:w':ns['w'], 'xmlns:wx':ns['wx'], 'xmlns:wp':ns['wp'],
+                'xmlns:a':ns['a'], 'xmlns:r':ns['r'] })
+        self.body = x.sub(self._root, 'w:body')
+        relations = x.document("Relationships", {
+                "xmlns":"http://schemas.openxmlformats.org/package/2006/relationships" })
+        x.sub(relations, "Relationship", {
+                "Id":"myrId1",
+                "Type":"http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument",
+                "Target":"word/document.xml" })
+        self._xmlwrite(relations, '_rels/.rels')
+        cTypes = x.document('Types', {
+                'xmlns':'http://schemas.openxmlformats.org/package/2006/content-types' })
         mime_types = { 'png':'image/png', 
                        'jpg':'image/jpeg', 
                        'xml':'application/xml', 
                        'rels':'application/vnd.openxmlformats-package.relationships+xml' }
         for e, c in mime_types.items():
-            type = content.createElement('Default')
-            type.setAttribute('Extension', e)
-            type.setAttribute('ContentType', c)
-            cTypes.appendChild(type)
+            x.sub(cTypes, 'Default', { 'Extension':e, 'ContentType':c })
         overrides = { '/word/document.xml':'application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml' }
         for p, c in overrides.items():
-            type = content.createElement('Override')
-            type.setAttribute('PartName', p)
-            type.setAttribute('ContentType', c)
-            cTypes.appendChild(type)
-        content.appendChild(cTypes)
-        self._xmlwrite(content, '[Content_Types].xml')
+            x.sub(cTypes, 'Override', { 'PartName':p, 'ContentType':c })
+        self._xmlwrite(cTypes, '[Content_Types].xml')
+        self.styles = dict(self.default_styles)
+        self.sequences = { }
         self.property = None
         self.settings = None
+        self.headers = { }
         self.header = None
         self.numberings = None
 
     def _load(self, filename):
-        zip = zipfile.ZipFile(filename, 'r')
-        zip.extractall(self.tmpdir)
-        wdoc = minidom.parse(zip.open('word/document.xml')).documentElement
-        wdoc.setAttribute('xmlns:wx', ns['wx'])
-        wdoc.setAttribute('xmlns:a', ns['a'])
-        self.body = wdoc.getElementsByTagName('w:body')[0]
+        x = self.xml
+        self.package = zip = Package(filename)
+        zip.stats = self.stats
+        self._root = wdoc = x.parse(zip.open('word/document.xml'))
+        x.set(wdoc, 'xmlns:wx', ns['wx'])
+        x.set(wdoc, 'xmlns:a', ns['a'])
+        self.body = x.iter(wdoc, 'w:body')[0]
         relfile = zip.open('word/_rels/document.xml.rels')
-        for n in minidom.parse(relfile).getElementsByTagName('Relationship'):
-            self.media[n.getAttribute('Id')] = ( n.getAttribute('Target'), 
-                                                 n.getAttribute('Type') )
-        sdoc = minidom.parse(zip.open('word/styles.xml'))
-        for s in sdoc.getElementsByTagName('w:style'):
-            style_id = s.getAttribute('w:styleId')
-            n = s.getElementsByTagName('w:name')[0]
-            style_name = n.getAttribute('w:val')
-            self.styles[style_name] = style_id
-        try:
-            self.property = CustomProperty(self, 
-                                           zip.open('docProps/custom.xml'))
-        except:
-            self.property = None
-        try:
-            self.settings = Settings(zip.open('word/settings.xml'))
-        except:
-            self.settings = None
-        try:
-            self.header = minidom.parse(zip.open('word/header1.xml'))
-        except:
-            self.header = None
-        try:
-            self.numberings = Numbering(zip.open('word/numbering.xml'))
-        except:
-            self.numberings = None
-        zip.close()
+        for n in x.iter(x.parse(relfile), 'Relationship'):
+            self.media[x.get(n, 'Id')] = ( x.get(n, 'Target'), 
+                                           x.get(n, 'Type') )
+            if x.get(n, 'TargetMode') == 'External':
+                self._external.add(x.get(n, 'Id'))
+
+    @_lazy
+    def styles(self):
+        '''Mapping of style names to style ids.
+        '''
+        styles = dict(self.default_styles)
+        if 'word/styles.xml' in self.package:
+            x = self.xml
+            sdoc = x.parse(self.package.open('word/styles.xml'))
+            for s in x.iter(sdoc, 'w:style'):
+                style_id = x.get(s, 'w:styleId')
+                n = x.iter(s, 'w:name')[0]
+                style_name = x.get(n, 'w:val')
+                styles[style_name] = style_id
+        return styles
+
+    @_lazy
+    def property(self):
+        '''Custom document properties.
+        '''
+        if 'docProps/custom.xml' in self.package:
+            return CustomProperty(self, 
+                                  self.package.open('docProps/custom.xml'))
+
+    @_lazy
+    def settings(self):
+        '''Document settings.
+        '''
+        if 'word/settings.xml' in self.package:
+            return Settings(self.xml, 
+                            self.package.open('word/settings.xml'))
+
+    @_lazy
+    def headers(self):
+        '''Header and footer parts, by part name.
+        '''
+        names = set([ 'word/header1.xml' ])
+        for target, type in self.media.values():
+            if type.endswith('/header') or type.endswith('/footer'):
+                names.add(target[1:] if target.startswith('/') 
+                          else 'word/' + target)
+        return dict((name, self.xml.parse(self.package.open(name)))
+                    for name in names if name in self.package)
+
+    @_lazy
+    def header(self):
+        '''First page header.
+        '''
+        return self.headers.get('word/header1.xml')
+
+    @_lazy
+    def numberings(self):
+        '''Numbering definitions of lists.
+        '''
+        if 'word/numbering.xml' in self.package:
+            return Numbering(self.xml, 
+                             self.package.open('word/numbering.xml'))
+
+    @_lazy
+    def sequences(self):
+        '''Number of SEQ fields (caption counters) in the body, by name.
+
+        This is counted once from the loaded document and then updated by
+        every appended Counter.
+        '''
+        x = self.xml
+        instrs = [ x.get(n, 'w:instr') 
+                   for n in x.iter(self.body, 'w:fldSimple') ]
+        instrs += [ x.text(n) for n in x.iter(self.body, 'w:instrText') ]
+        sequences = { }
+        for instr in instrs:
+            instr = instr.split()
+            if len(instr) > 1 and instr[0] == 'SEQ':
+                sequences[instr[1]] = sequences.get(instr[1], 0) + 1
+        return sequences
+
+    @_lazy
+    def _content_types(self):
+        '''Content types of the package parts.
+        '''
+        return self.xml.parse(self.package.open('[Content_Types].xml'))
+
+    def _add_content_type(self, name, content_type, override = False):
+        '''Declare the content type of a part, by its extension or, with
+        override, by its name.
+        '''
+        x = self.xml
+        if override:
+            tag, key, value = 'Override', 'PartName', '/' + name
+        else:
+            tag, key = 'Default', 'Extension'
+            value = posixpath.splitext(name)[1][1:].lower()
+        for n in x.iter(self._content_types, tag):
+            if x.get(n, key).lower() == value.lower():
+                return
+        x.sub(self._content_types, tag, 
+              { key:value, 'ContentType':content_type })
+
+    def _parsed(self, name):
+        '''Return a subdocument if it was already parsed, else None.
+        '''
+        return self.__dict__.get(name)
 
     def __iadd__(self, other):
         if isinstance(other, (str, unicode)):
@@ -303,94 +1315,514 @@ class Document(object):
         elif _have_matplotlib and isinstance(other, matplotlib.figure.Figure):
             self += MatplotlibFigure(other)
         else:
-            other.append_to(self, self.body)
+            with self.stats.phase('append', other):
+                other.append_to(self, self.body)
+                if self._index is not None:
+                    self._index.update()
+                if self._stream is not None:
+                    self._drain()
         return self
 
-    def appendMedia(self, fname):
+    def index(self):
+        '''Return the search Index of the body, which is built on the first
+        call and then kept up to date with appended content.
+        '''
+        if self._stream is not None:
+            raise IOError('index() is not available in stream mode')
+        if self._index is None:
+            self._index = Index(self)
+        return self._index
+
+    def appendMedia(self, fname, data = None, id = None):
         '''Append an external file.
 
         The file will be copied into the document tree and a reference to the
         file is returned.
+
+        If data is given, it is stored as word/media/fname, renamed if
+        another file has that name already. Media with the same content are
+        stored only once and share the same reference, unless id is given:
+        then id becomes another reference to the stored file.
         '''
-        id = 'rId%i' % (len(self.media) + 1)
         type = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/image"
+        if data is not None:
+            digest = hashlib.sha1(data).hexdigest()
+            known = self._media_hashes.get(digest)
+            if known is not None:
+                if id is None:
+                    return known
+                self.media[id] = self.media[known]
+                return id
+            fname = self._media_name(fname)
+            self.package['word/media/%s' % fname] = data
+            ext = posixpath.splitext(fname)[1][1:].lower()
+            if ext in _image_types:
+                self._add_content_type(fname, _image_types[ext])
+        if id is None:
+            id = self._media_id()
         self.media[id] = ('media/%s' % fname, type)
+        if data is not None:
+            self._media_hashes[digest] = id
+        return id
+
+    def _media_id(self):
+        '''Return the next unused relationship id.
+        '''
+        i = len(self.media) + 1
+        while 'rId%i' % i in self.media or 'rId%i' % i in self._pending:
+            i += 1
+        return 'rId%i' % i
+
+    def _submit_media(self, fname, render, *args):
+        '''Append an image that is created by render(*args) in a worker
+        process. render and args must be picklable.
+
+        The returned reference may be used right away; the image is added
+        to the document by _join_media() before the document is written.
+        Without the concurrent.futures module, on a single CPU, or where no
+        worker processes can be started (like in a daemon process), the
+        image is rendered immediately.
+        '''
+        if not _have_futures or multiprocessing.cpu_count() < 2:
+            return self.appendMedia(fname, render(*args))
+        try:
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    multiprocessing.cpu_count())
+            future = self._executor.submit(render, *args)
+        except (AssertionError, OSError):
+            return self.appendMedia(fname, render(*args))
+        id = self._media_id()
+        self._pending[id] = (fname, future)
         return id
 
+    def _join_media(self):
+        '''Wait for the images that are rendered in worker processes and
+        add them to the document.
+        '''
+        if not self._pending:
+            return
+        with self.stats.phase('media'):
+            while self._pending:
+                id, (fname, future) = self._pending.popitem(last = False)
+                self.appendMedia(fname, future.result(), id)
+
+    def _media_name(self, fname):
+        '''Return a name in word/media that is not used yet.
+        '''
+        base, ext = os.path.splitext(fname)
+        i = 1
+        while 'word/media/%s' % fname in self.package:
+            fname = '%s%i%s' % (base, i, ext)
+            i += 1
+        return fname
+
+    @_lazy
+    def _media_hashes(self):
+        '''Mapping of the SHA-1 digests of the images to their ids.
+        '''
+        hashes = { }
+        for id, (target, type) in sorted(self.media.items()):
+            name = target[1:] if target.startswith('/') else 'word/' + target
+            if type.endswith('/image') and name in self.package:
+                with self.package.open(name) as fp:
+                    hashes.setdefault(hashlib.sha1(fp.read()).hexdigest(), 
+                                      id)
+        return hashes
+
+    def _fragment(self, build, *key):
+        '''Return a property element (like w:rPr or w:pPr) from the cache.
+
+        The element is created by build(self, *key) on first use, and the
+        cached element itself is returned. With backends that cannot share
+        an element between several parents (minidom), a copy would cost as
+        much as building the element, so it is built every time.
+        '''
+        if not self.xml.shared:
+            return build(self, *key)
+        el = self._fragments.get((build, key))
+        if el is None:
+            el = self._fragments[(build, key)] = build(self, *key)
+        return el
+
     def numbering(self, level, indent, hanging, bullet):
         if self.numberings is None:
-            self.numberings = Numbering()
+            self._create_numberings()
         return self.numberings.add(level, indent, hanging, bullet)
 
-    def _xmlwrite(self, document, path):
-        fp = codecs.open(os.path.join(self.tmpdir, path), 'w', 'utf-8')
-        document.writexml(fp, encoding = "UTF-8")
-#        document.writexml(fp, "", "  ", "\n", encoding = "UTF-8")
-        fp.close()
+    def _create_numberings(self):
+        self.numberings = Numbering(self.xml)
+        self.media[self._media_id()] = ('numbering.xml', 
+                                        _relationships + 'numbering')
+        self._add_content_type('word/numbering.xml', 'application/vnd.openxmlformats-officedocument.wordprocessingml.numbering+xml', True)
+
+    def appendDocument(self, fname, pagebreak = False):
+        '''Append the body of another document.
+
+        Images are added with appendMedia(), so that they are stored only
+        once. External links keep their targets, and other parts that the
+        body refers to (like embedded objects) are copied, without the
+        parts they refer to themselves. List definitions get new numbers,
+        and caption counters (SEQ fields) continue the numbering of this
+        document. Headers, footers and the page setup of the appended
+        document are dropped, as are styles that this document does not
+        define.
+
+        With pagebreak, the appended body starts on a new page. In 'stream'
+        mode, the body is written out right away.
+        '''
+        x = self.xml
+        sequences = self.sequences
+        source = Package(fname)
+        try:
+            root = x.parse(source.open('word/document.xml'))
+            relations = { }
+            if 'word/_rels/document.xml.rels' in source:
+                rels = x.parse(source.open('word/_rels/document.xml.rels'))
+                for n in x.iter(rels, 'Relationship'):
+                    relations[x.get(n, 'Id')] = (
+                        x.get(n, 'Target'), x.get(n, 'Type'),
+                        x.get(n, 'TargetMode') == 'External')
+            types = x.parse(source.open('[Content_Types].xml'))
+            numbers = { }
+            if 'word/numbering.xml' in source:
+                if self.numberings is None:
+                    self._create_numberings()
+                numbers = self.numberings.merge(
+                    Numbering(x, source.open('word/numbering.xml')))
+            body = x.iter(root, 'w:body')[0]
+            children = [ el for el in x.children(body) 
+                         if x.tag(el) != 'w:sectPr' ]
+            declarations = [ (name, value) 
+                             for name, value in x.attributes(root)
+                             if name.startswith('xmlns') and 
+                             not x.get(self._root, name) ]
+            if self._stream is None:
+                for name, value in declarations:
+                    x.set(self._root, name, value)
+                declarations = [ ]
+            ids = { }
+            for el in children:
+                x.remove(body, el)
+                for name, value in declarations:
+                    x.set(el, name, value)
+                self._import(el, source, relations, types, numbers, ids)
+                self._renumber(el, sequences)
+            # Detach the trailing sectPr once, instead of inserting every
+            # element before it
+            end = x.children(self.body)[-1:] if self._stream is None else []
+            end = end[0] if end and x.tag(end[0]) == 'w:sectPr' else None
+            if end is not None:
+                x.remove(self.body, end)
+            if pagebreak:
+                children.insert(0, x.create(self.body, 'w:p'))
+                x.sub(x.sub(children[0], 'w:r'), 'w:br', 
+                      { 'w:type':'page' })
+            for el in children:
+                x.append(self.body, el)
+            if end is not None:
+                x.append(self.body, end)
+        finally:
+            source.close()
+        if self._index is not None:
+            self._index.invalidate()
+        if self._parsed('property') is not None:
+            self.property.invalidate()
+        if self._stream is not None:
+            self._drain()
+
+    def _import(self, el, source, relations, types, numbers, ids):
+        '''Adapt the references of an element of another document.
+        '''
+        x = self.xml
+        sections = x.iter(el, 'w:sectPr')
+        if x.tag(el) == 'w:sectPr':
+            sections = [ el ] + list(sections)
+        for sectPr in sections:
+            for n in x.children(sectPr):
+                if x.tag(n) in ('w:headerReference', 'w:footerReference'):
+                    x.remove(sectPr, n)
+        for n in x.iter(el, '*'):
+            if x.tag(n) == 'w:numId':
+                val = x.get(n, 'w:val')
+                if val in numbers:
+                    x.set(n, 'w:val', numbers[val])
+                continue
+            for attr in ('r:id', 'r:embed', 'r:link'):
+                id = x.get(n, attr)
+                if id and id in relations:
+                    if id not in ids:
+                        ids[id] = self._import_relation(source, types,
+                                                        *relations[id])
+                    x.set(n, attr, ids[id])
+
+    def _import_relation(self, source, types, target, type, external):
+        '''Add a relationship of another document, copying its target part,
+        and return its new id.
+        '''
+        x = self.xml
+        if external:
+            id = self._media_id()
+            self.media[id] = (target, type)
+            self._external.add(id)
+            return id
+        name = (target[1:] if target.startswith('/') 
+                else posixpath.normpath(posixpath.join('word', target)))
+        if name not in source:
+            # Keep the dangling relationship as it was
+            id = self._media_id()
+            self.media[id] = (target, type)
+            return id
+        ext = posixpath.splitext(name)[1][1:].lower()
+        content_type = None
+        for n in x.iter(types, 'Override'):
+            if x.get(n, 'PartName') == '/' + name:
+                content_type = x.get(n, 'ContentType')
+        if type.endswith('/image') and content_type is None:
+            id = self.appendMedia(posixpath.basename(name), source[name])
+            for n in x.iter(types, 'Default'):
+                if x.get(n, 'Extension').lower() == ext:
+                    self._add_content_type(name, x.get(n, 'ContentType'))
+            return id
+        base, ext = posixpath.splitext(name)
+        newname, i = name, 1
+        while newname in self.package:
+            newname = '%s%i%s' % (base, i, ext)
+            i += 1
+        self.package[newname] = source[name]
+        if content_type is not None:
+            self._add_content_type(newname, content_type, True)
+        else:
+            for n in x.iter(types, 'Default'):
+                if x.get(n, 'Extension').lower() == ext[1:].lower():
+                    self._add_content_type(newname, x.get(n, 'ContentType'))
+        id = self._media_id()
+        self.media[id] = (posixpath.relpath(newname, 'word'), type)
+        return id
 
-    def writeto(self, filename):
+    def _renumber(self, el, sequences):
+        '''Give the SEQ fields in an element the next numbers of their
+        counters.
+        '''
+        x = self.xml
+        result = None
+        for n in [ el ] + list(x.iter(el, '*')):
+            tag = x.tag(n)
+            if tag == 'w:fldSimple':
+                num = self._next_sequence(x.get(n, 'w:instr'), sequences)
+                texts = x.iter(n, 'w:t')
+                if num is not None and texts:
+                    x.set_text(texts[0], '%i' % num)
+            elif tag == 'w:instrText':
+                result = self._next_sequence(x.text(n), sequences)
+            elif tag == 'w:t' and result is not None:
+                # first text after the instruction of a complex field
+                x.set_text(n, '%i' % result)
+                result = None
+
+    @staticmethod
+    def _next_sequence(instr, sequences):
+        instr = instr.split()
+        if len(instr) < 2 or instr[0] != 'SEQ':
+            return None
+        num = sequences[instr[1]] = sequences.get(instr[1], 0) + 1
+        return num
+
+    def _xmlwrite(self, root, path):
+        self.package[path] = self.xml.tostring(root)
+
+    def writeto(self, filename, compresslevel = None):
         '''Write the document to a file. The file will be overwritten without
         warning.
+
+        compresslevel is the zlib level (0..9) for the XML parts; images are
+        stored without compression.
         '''
-        self._xmlwrite(self.body.ownerDocument,
-                       os.path.join('word', 'document.xml'))
-        if self.property is not None:
-            self._xmlwrite(self.property.doc, 
-                           os.path.join('docProps', 'custom.xml'))
-        if self.settings is not None:
-            self._xmlwrite(self.settings.doc, 
-                           os.path.join('word', 'custom.xml'))
-        if self.header is not None:
-            self._xmlwrite(self.header, 
-                           os.path.join('word', 'header1.xml'))
-        if self.numberings is not None:
-            self._xmlwrite(self.numberings.doc, 
-                           os.path.join('word', 'numbering.xml'))
-        relations = minidom.Document()
-        relsElem = relations.createElement("Relationships")
-        relsElem.setAttribute("xmlns", "http://schemas.openxmlformats.org/package/2006/relationships")
-        relations.appendChild(relsElem)
+        if self._stream is not None:
+            raise IOError('writeto() is not available in stream mode')
+        self._join_media()
+        self._xmlwrite(self._root, 'word/document.xml')
+        self._writeparts()
+        with self.stats.phase('zip'):
+            self.package.save(filename, compresslevel)
+
+    def _writeparts(self):
+        if self._parsed('property') is not None:
+            self._xmlwrite(self.property.doc, 'docProps/custom.xml')
+        if self._parsed('settings') is not None:
+            self._xmlwrite(self.settings.doc, 'word/settings.xml')
+        headers = dict(self._parsed('headers') or { })
+        if self._parsed('header') is not None:
+            headers['word/header1.xml'] = self.header
+        for name, header in headers.items():
+            self._xmlwrite(header, name)
+        if self._parsed('numberings') is not None:
+            self._xmlwrite(self.numberings.doc, 'word/numbering.xml')
+        x = self.xml
+        relations = x.document("Relationships", {
+                "xmlns":"http://schemas.openxmlformats.org/package/2006/relationships" })
         for id, (target, type) in self.media.items():
-            relshipElem = relations.createElement("Relationship")
-            relshipElem.setAttribute("Id", id)
-            relshipElem.setAttribute("Type", type)
-            relshipElem.setAttribute("Target", target)
-            relsElem.appendChild(relshipElem)
-        self._xmlwrite(relations, 
-                       os.path.join('word', "_rels", 'document.xml.rels'))
-        f = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED)
-        for dirpath,dirnames,filenames in os.walk(self.tmpdir):
-            for filename in filenames:
-                f.write(os.path.join(dirpath,filename),
-                        os.path.join(dirpath,filename).replace(self.tmpdir,''))
-        f.close()
+            rel = x.sub(relations, "Relationship", 
+                        { "Id":id, "Type":type, "Target":target })
+            if id in self._external:
+                x.set(rel, "TargetMode", "External")
+        self._xmlwrite(relations, 'word/_rels/document.xml.rels')
+        if self._parsed('_content_types') is not None:
+            self._xmlwrite(self._content_types, '[Content_Types].xml')
 
     def flush(self):
         '''Flush all changes to disk.
         
-        This works only if the document was opened in 'update' or 'append'
-        mode.
+        This works only if the document was opened in 'update', 'append' or
+        'stream' mode.
         '''
-        if ((self.mode is 'update' or self.mode is 'append') 
+        if self._stream is not None:
+            self._drain()
+        elif ((self.mode == 'update' or self.mode == 'append') 
             and self.fname is not None):
             self.writeto(self.fname)
 
+    def awriteto(self, filename, compresslevel = None, executor = None):
+        '''Like writeto(), but to be awaited in an asyncio event loop.
+
+        The document must not be changed until the writing is done.
+        '''
+        return _run(executor, self.writeto, filename, compresslevel)
+
+    def aflush(self, executor = None):
+        '''Like flush(), but to be awaited in an asyncio event loop.
+        '''
+        return _run(executor, self.flush)
+
+    def aclose(self, executor = None):
+        '''Like close(), but to be awaited in an asyncio event loop.
+        '''
+        return _run(executor, self.close)
+
+    def aextend(self, items):
+        '''Append all elements of an asynchronous iterable, as they arrive:
+
+            await doc.aextend(rows_from_database())
+
+        Returns an asyncio future for the document.
+        '''
+        loop = asyncio.get_event_loop()
+        done = loop.create_future()
+        items = items.__aiter__()
+
+        def step(future = None):
+            if future is not None:
+                try:
+                    self.__iadd__(future.result())
+                except StopAsyncIteration:
+                    done.set_result(self)
+                    return
+                except Exception as e:
+                    done.set_exception(e)
+                    return
+            asyncio.ensure_future(items.__anext__()).add_done_callback(step)
+
+        step()
+        return done
+
     def close(self):
-        '''Close the document and clean up the file space.
+        '''Close the document and the source file.
         
         In 'update'/'append' mode, the changes are flushed to the document
-        file.
+        file. In 'stream' mode, the document file is completed.
         '''
-        self.flush()
-        shutil.rmtree(self.tmpdir)
+        if self._stream is not None:
+            self._closestream()
+        else:
+            self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.package.close()
+
+class Template(object):
+    '''Document template, compiled for fast filling of custom properties.
+
+    The template is parsed only once. Every DOCPROPERTY field result and
+    every custom property value becomes a slot between static byte
+    strings, so that render() only splices the values into the parts
+    without any XML processing. Parts without slots are compressed once
+    and then copied into every output file.
+    '''
+    def __init__(self, fname, backend = 'etree'):
+        doc = Document(fname, 'copyonwrite', backend)
+        self.names = list(doc.property) if doc.property is not None else []
+        self.defaults = dict((name, doc.property[name] or u'') 
+                             for name in self.names)
+        token = uuid.uuid4().hex
+        if self.names:
+            doc.property.update(dict((name, u'@@%s:%i@@' % (token, i))
+                                     for i, name in enumerate(self.names)))
+        doc._xmlwrite(doc._root, 'word/document.xml')
+        doc._writeparts()
+        slot = re.compile(('@@%s:([0-9]+)@@' % token).encode('ascii'))
+        self.parts = [ ]
+        for name in doc.package:
+            raw = doc.package.raw(name)
+            if raw is not None:
+                self.parts.append((name, raw))
+                continue
+            pieces = slot.split(doc.package[name])
+            if len(pieces) == 1:
+                self.parts.append((name, doc.package.compressed(name)))
+                continue
+            for i in range(1, len(pieces), 2):
+                pieces[i] = int(pieces[i])
+            self.parts.append((name, pieces))
+        doc.close()
 
-    def __del__(self):
-        shutil.rmtree(self.tmpdir)
+    def render(self, values = None, filename = None):
+        '''Fill the custom properties and write the document.
+
+        values: dictionary with the property values, which are converted to
+                text. Properties that are not given keep their value from
+                the template.
+        filename: Output file name or file object. If it is None, the
+                  document is returned as a byte string.
+        '''
+        filled = dict(self.defaults)
+        if values:
+            unknown = set(values) - set(self.names)
+            if unknown:
+                raise KeyError('Template has no properties %s' 
+                               % ', '.join(sorted(unknown)))
+            filled.update(values)
+        slots = [ escape(unicode(filled[name])).encode('utf-8') 
+                  for name in self.names ]
+        fp = io.BytesIO() if filename is None else filename
+        f = zipfile.ZipFile(fp, 'w', zipfile.ZIP_DEFLATED)
+        for name, pieces in self.parts:
+            if isinstance(pieces, tuple):
+                _write_compressed(f, name, *pieces)
+                continue
+            data = b''.join(slots[p] if i % 2 else p 
+                            for i, p in enumerate(pieces))
+            f.writestr(name, data, _compress_type(name))
+        f.close()
+        if filename is None:
+            return fp.getvalue()
 
 class Text(object):
     '''Structure containing some text with the same formatting options.
     
     '''
+    underlines = {
+        0:'off', False:'none',
+        1:'single', True:'single', '_':'single',
+        2:'double', '=':'double',
+        '#':'thick',
+        '-':'words',
+        ',':'dash',
+        '.':'dotted',
+        ';':'dot-dash',
+        }
+    __slots__ = ('content', 'bold', 'italic', 'underline')
+
     def __init__(self, content, bold = None, italic = None, underline = None):
         self.content = content if isinstance(content, unicode) \
             else unicode(content)
@@ -399,56 +1831,65 @@ class Text(object):
         self.underline = underline
 
     def append_to(self, doc, target):
-        r = target.ownerDocument.createElement('w:r')
-        style = False
-        rpr = target.ownerDocument.createElement('w:rPr')
-        if self.bold is not None:
-            style = True
-            wb = target.ownerDocument.createElement('w:b')
-            if not self.bold:
-                wb.setAttribute('w:val', 'off')
-            rpr.appendChild(wb)
-        if self.italic is not None:
-            style = True
-            wi = target.ownerDocument.createElement('w:i')
-            if not self.italic:
-                wi.setAttribute('w:val', 'off')
-            rpr.appendChild(wi)
-        if self.underline is not None:
-            style = True
-            wu = target.ownerDocument.createElement('w:u')
-            styles = {
-                0:'off', False:'none',
-                1:'single', True:'single', '_':'single',
-                2:'double', '=':'double',
-                '#':'thick',
-                '-':'words',
-                ',':'dash',
-                '.':'dotted',
-                ';':'dot-dash',
-                }
-            wu.setAttribute('w:val', styles.get(self.underline, 'none'))
-            rpr.appendChild(wu)
-        if style:
-            r.appendChild(rpr)
-        if self.content.startswith(' '):
-            t = target.ownerDocument.createElement('w:t')
-            t.setAttribute('xml:space', 'preserve')
-            t.appendChild(target.ownerDocument.createTextNode(' '))
-            r.appendChild(t)
-        t = target.ownerDocument.createElement('w:t')
-        t.appendChild(target.ownerDocument.createTextNode(self.content.strip()))
-        r.appendChild(t)
-        if self.content.endswith(' '):
-            t = target.ownerDocument.createElement('w:t')
-            t.setAttribute('xml:space', 'preserve')
-            t.appendChild(target.ownerDocument.createTextNode(' '))
-            r.appendChild(t)
-        target.appendChild(r)
+        x = doc.xml
+        r = x.sub(target, 'w:r')
+        if (self.bold is not None or self.italic is not None 
+            or self.underline is not None):
+            x.append(r, doc._fragment(Text._properties, self.bold, 
+                                      self.italic, self.underline))
+        _append_text(x, r, self.content)
+
+    @staticmethod
+    def _properties(doc, bold, italic, underline):
+        x = doc.xml
+        rpr = x.create(doc.body, 'w:rPr')
+        if bold is not None:
+            x.sub(rpr, 'w:b', None if bold else { 'w:val':'off' })
+        if italic is not None:
+            x.sub(rpr, 'w:i', None if italic else { 'w:val':'off' })
+        if underline is not None:
+            x.sub(rpr, 'w:u', 
+                  { 'w:val':Text.underlines.get(underline, 'none') })
+        return rpr
+
+# Underline values of w:u, mapped back to the codes of Text
+_underline_codes = dict((v, k) for k, v in Text.underlines.items() 
+                        if isinstance(k, str))
+_underline_codes.update({ 'none':False, 'off':0 })
+
+def _append_text(x, r, content):
+    '''Append the w:t elements for a text to a run.
+    '''
+    if content.startswith(' '):
+        x.sub(r, 'w:t', { 'xml:space':'preserve' }, ' ')
+    x.sub(r, 'w:t', text = content.strip())
+    if content.endswith(' '):
+        x.sub(r, 'w:t', { 'xml:space':'preserve' }, ' ')
+
+def _append_content(doc, p, content):
+    '''Append the runs of a paragraph. Unformatted text is kept as a plain
+    string instead of a Text object.
+    '''
+    x = doc.xml
+    for c in content:
+        if isinstance(c, Text):
+            c.append_to(doc, p)
+        else:
+            _append_text(x, x.sub(p, 'w:r'), c)
 
 class Paragraph(object):
     '''Structure containing one text paragraph.
+
+    content holds Text objects, and plain strings for unformatted text.
     '''
+    alignments = {
+        'l':'left', 'left':'left', '<':'left',
+        'r':'right', 'right':'right', '>':'right',
+        'c':'center', 'center':'center', 
+        'b':'both', 'block':'both', 'both':'both', '=':'both',
+        }
+    __slots__ = ('style', 'align', 'content')
+
     def __init__(self, content = None, style = None, align = None):
         self.style = style
         self.align = align
@@ -456,102 +1897,127 @@ class Paragraph(object):
         if content:
             self.__iadd__(content)
 
+    @property
+    def text(self):
+        '''The text of the paragraph, without formatting.
+        '''
+        return u''.join(c if isinstance(c, unicode) else c.content 
+                        for c in self.content)
+
     def __iadd__(self, other):
-        self.content.append(other if isinstance(other, Text) else Text(other))
+        if isinstance(other, Text) or isinstance(other, unicode):
+            self.content.append(other)
+        else:
+            self.content.append(unicode(other))
+        return self
 
     def append_to(self, doc, target, indent = None, numbering = None):
-        p = target.ownerDocument.createElement('w:p')
+        x = doc.xml
+        p = x.sub(target, 'w:p')
         if self.style is not None or self.align is not None or numbering is not None or indent is not None:
-            pPr = target.ownerDocument.createElement('w:pPr')
-            if self.style:
-                pStyle = target.ownerDocument.createElement('w:pStyle')
-                pStyle.setAttribute('w:val', doc.styles[self.style])
-                pPr.appendChild(pStyle)
-            alignments = {
-                'l':'left', 'left':'left', '<':'left',
-                'r':'right', 'right':'right', '>':'right',
-                'c':'center', 'center':'center', 
-                'b':'both', 'block':'both', 'both':'both', '=':'both',
-                }
-            a = alignments.get(self.align)
-            if a:
-                pjc = target.ownerDocument.createElement('w:jc')
-                pjc.setAttribute('w:val', a)
-                pPr.appendChild(pjc)
-            if numbering:
-                numpr = target.ownerDocument.createElement('w:numPr')
-                ilvl = target.ownerDocument.createElement('w:ilvl')
-                ilvl.setAttribute('w:val', '%i' % numbering[0])
-                numpr.appendChild(ilvl)
-                numid = target.ownerDocument.createElement('w:numId')
-                numid.setAttribute('w:val', '%i' % numbering[1])
-                numpr.appendChild(numid)
-                pPr.appendChild(numpr)
-            if indent:
-                ind = target.ownerDocument.createElement('w:ind')
-                ind.setAttribute('w:left', '%i' % indent)
-                pPr.appendChild(ind)
-            p.appendChild(pPr)
-        for c in self.content:
-            c.append_to(doc, p)
-        target.appendChild(p)
+            style = doc.styles[self.style] if self.style else None
+            x.append(p, doc._fragment(Paragraph._properties, style,
+                                      self.align, numbering, indent))
+        _append_content(doc, p, self.content)
+
+    @staticmethod
+    def _properties(doc, style, align, numbering, indent):
+        x = doc.xml
+        pPr = x.create(doc.body, 'w:pPr')
+        if style:
+            x.sub(pPr, 'w:pStyle', { 'w:val':style })
+        a = Paragraph.alignments.get(align)
+        if a:
+            x.sub(pPr, 'w:jc', { 'w:val':a })
+        if numbering:
+            numpr = x.sub(pPr, 'w:numPr')
+            x.sub(numpr, 'w:ilvl', { 'w:val':'%i' % numbering[0] })
+            x.sub(numpr, 'w:numId', { 'w:val':'%i' % numbering[1] })
+        if indent:
+            x.sub(pPr, 'w:ind', { 'w:left':'%i' % indent })
+        return pPr
 
 class Header(Paragraph):
     '''Caption header.
     '''
+    __slots__ = ()
+
     def __init__(self, level, content):
         Paragraph.__init__(self, content, style = 'heading %i' % level)
 
 class Counter(Text):
     '''Counter, for table and figure captions
     '''
+    __slots__ = ('name',)
+
     def __init__(self, name, bold = None, italic = None, underline = None):
         Text.__init__(self, '0', bold, italic, underline)
         self.name = name
 
-    def get_counter(self, target):
-        instr = ' SEQ %s \* ARABIC ' % self.name
-        return len([n for n in target.getElementsByTagName('w:fldSimple')
-                    if n.getAttribute('w:instr').strip() == instr.strip()]) + 1
+    def get_counter(self, doc):
+        return doc.sequences.get(self.name, 0) + 1
 
     def append_to(self, doc, target):
-        num = self.get_counter(target.ownerDocument)
-        fld = target.ownerDocument.createElement('w:fldSimple')
-        fld.setAttribute('w:instr', ' SEQ %s \* ARABIC ' % self.name)
+        num = self.get_counter(doc)
+        doc.sequences[self.name] = num
+        fld = doc.xml.sub(target, 'w:fldSimple', 
+                          { 'w:instr':' SEQ %s \\* ARABIC ' % self.name })
         self.content = '%i' % num
         Text.append_to(self, doc, fld)
-        target.appendChild(fld)
 
 class Caption(Paragraph):
     '''Table or figure caption
     '''
+    __slots__ = ('name', 'counter')
+
     def __init__(self, name, content, style = 'caption'):
         Paragraph.__init__(self, content, style)
         self.name = name
         self.counter = Counter(name)
 
     def append_to(self, doc, target):
-        p = target.ownerDocument.createElement('w:p')
+        x = doc.xml
+        p = x.sub(target, 'w:p')
         if self.style is not None:
-            pPr = target.ownerDocument.createElement('w:pPr')
-            pStyle = target.ownerDocument.createElement('w:pStyle')
-            pStyle.setAttribute('w:val', doc.styles[self.style])
-            pPr.appendChild(pStyle)
-            p.appendChild(pPr)
+            x.append(p, doc._fragment(Paragraph._properties, 
+                                      doc.styles[self.style], 
+                                      None, None, None))
         Text('%s ' % self.name).append_to(doc, p)
         self.counter.append_to(doc, p)
         Text(': ').append_to(doc, p)
-        for c in self.content:
-            c.append_to(doc, p)
-        target.appendChild(p)
+        _append_content(doc, p, self.content)
 
 class Table(object):
     '''Simple table.
     
-    cells should be a 2dim array.
+    cells should be a 2dim array: a list of rows, a 2dim numpy array, or a
+    dictionary of columns, whose keys make up the header row. It may also be
+    any iterable of rows, like a generator or a database cursor. Such rows
+    are consumed only while the table is appended to the document, and in
+    'stream' mode every row is written out as soon as it is created.
+
+    A table needs at least one row (the header counts); appending a table
+    without rows raises ValueError.
+
+    header is an optional first row. For a dictionary, header selects the
+    columns and their order; without it, the order of the dictionary is
+    used, which is only defined for an OrderedDict. The number of columns is
+    taken from columns, or else from the first row.
+
+    formats is a format string, a list with a format string (or None) per
+    column, or a dictionary from column names (the keys of cells or the
+    entries of header) to format strings, for the values that are not text.
+    Numpy arrays and columns are formatted per column, and plain values are
+    written without creating Paragraph and Text objects for every cell.
     '''
-    def __init__(self, cells, caption = None, style = None):
+    __slots__ = ('cells', 'caption', 'style', 'formats', 'columns', 'header')
+
+    def __init__(self, cells, caption = None, style = None, formats = None,
+                 columns = None, header = None):
         self.cells = cells
+        self.formats = formats
+        self.columns = columns
+        self.header = header
         if caption is not None:
             self.caption = Caption('Table', caption)
         else:
@@ -559,170 +2025,224 @@ class Table(object):
         self.style = style
 
     def append_to(self, doc, target):
+        x = doc.xml
+        rows = iter(self._rows())
+        first = next(rows, None)
+        if first is None:
+            raise ValueError('Table has no rows')
+        rows = itertools.chain([ first ], rows)
         if self.caption is not None:
             self.caption.append_to(doc, target)
-        tbl = target.ownerDocument.createElement('w:tbl')
-        tblPr = target.ownerDocument.createElement('w:tblPr')
-        tblW = target.ownerDocument.createElement('w:tblW')
-        tblW.setAttribute('w:w', '5000')
-        tblW.setAttribute('w:type', 'pct')
-        tblPr.appendChild(tblW)
+        tbl = x.sub(target, 'w:tbl')
+        tblPr = x.sub(tbl, 'w:tblPr')
+        x.sub(tblPr, 'w:tblW', { 'w:w':'5000', 'w:type':'pct' })
         if self.style is not None:
-            tblStyle = target.ownerDocument.createElement('w:tblStyle')
-            tblStyle.setAttribute('w:val', self.style)
-            tblPr.appendChild(tblStyle)
+            x.sub(tblPr, 'w:tblStyle', { 'w:val':self.style })
+        else:
+            tblBorders = x.sub(tblPr, 'w:tblBorders')
+            x.sub(tblBorders, 'w:bottom', { 'w:val':'single', 'w:sz':'4',
+                                            'wx:bdrwidth':'10', 'w:space':'0',
+                                            'w:color':'auto' })
+        x.sub(tblPr, 'w:tblLook', { 'w:val':'01E0' })
+        columns = self.columns
+        if columns is None:
+            columns = len(first)
+        tblGrid = x.sub(tbl, 'w:tblGrid')
+        for c in range(columns):
+            x.sub(tblGrid, 'w:gridCol')
+        if doc._stream is not None and target is doc.body:
+            tail = doc._stream_open(tbl)
+            for row in rows:
+                self._append_row_to(doc, tbl, row)
+                doc._stream_children(tbl)
+            doc._stream.write(tail)
         else:
-            tblBorders = target.ownerDocument.createElement('w:tblBorders')
-            bottom = target.ownerDocument.createElement('w:bottom')
-            bottom.setAttribute('w:val', 'single')
-            bottom.setAttribute('w:sz', '4')
-            bottom.setAttribute('wx:bdrwidth', '10')
-            bottom.setAttribute('w:space', '0')
-            bottom.setAttribute('w:color', 'auto')
-            tblBorders.appendChild(bottom)
-            tblPr.appendChild(tblBorders)
-        tblLook = target.ownerDocument.createElement('w:tblLook')
-        tblLook.setAttribute('w:val', '01E0')
-        tblPr.appendChild(tblLook)
-        tbl.appendChild(tblPr)
-        tblGrid = target.ownerDocument.createElement('w:tblGrid')
-        for c in self.cells[0]:
-            tblGrid.appendChild(target.ownerDocument.createElement('w:gridCol'))
-        tbl.appendChild(tblGrid)
-        target.appendChild(tbl)
-        for row in self.cells:
-            self._append_row_to(doc, tbl, row)
+            for row in rows:
+                self._append_row_to(doc, tbl, row)
+
+    def _format(self, j, key = None):
+        if isinstance(self.formats, (list, tuple)):
+            return self.formats[j]
+        if isinstance(self.formats, dict):
+            if key is None and self.header is not None and \
+                    j < len(self.header):
+                key = self.header[j]
+            return self.formats.get(key)
+        return self.formats
+
+    def _format_column(self, j, column, key = None):
+        fmt = self._format(j, key)
+        if _have_numpy:
+            column = numpy.asarray(column)
+            if fmt is not None and column.dtype.kind not in 'SUO':
+                return numpy.char.mod(fmt, column)
+            return column.astype(unicode)
+        if fmt is not None:
+            return [ v if isinstance(v, basestring) else fmt % v 
+                     for v in column ]
+        return [ unicode(v) for v in column ]
+
+    def _rows(self):
+        '''Return the rows, with numpy arrays and columns formatted.
+        '''
+        cells = self.cells
+        if isinstance(cells, dict):
+            header = self.header
+            if header is None:
+                if (type(cells) is dict and 
+                    isinstance(self.formats, (list, tuple))):
+                    raise ValueError('The column order of a dict is not '
+                                     'defined; pass header, an OrderedDict '
+                                     'or formats by column name')
+                header = list(cells.keys())
+            columns = [ self._format_column(j, cells[k], k) 
+                        for j, k in enumerate(header) ]
+            return [ list(header) ] + list(zip(*columns))
+        if _have_numpy and isinstance(cells, numpy.ndarray):
+            columns = [ self._format_column(j, cells[:,j]) 
+                        for j in range(cells.shape[1]) ]
+            cells = zip(*columns)
+        if self.header is not None:
+            return itertools.chain([ self.header ], cells)
+        return cells
 
     def _append_row_to(self, doc, target, row):
-        tr = target.ownerDocument.createElement('w:tr')
-        for c in row:
-            tc = target.ownerDocument.createElement('w:tc')
+        x = doc.xml
+        tr = x.sub(target, 'w:tr')
+        for j, c in enumerate(row):
+            tc = x.sub(tr, 'w:tc')
             if isinstance(c, Paragraph):
                 c.append_to(doc, tc)
-            elif isinstance(c, (str, unicode, Text)):
+            elif isinstance(c, list):
+                for item in c:
+                    item.append_to(doc, tc)
+            elif isinstance(c, Text):
                 Paragraph(c).append_to(doc, tc)
             else:
-                Paragraph(c).append_to(doc, str(tc))
-            tr.appendChild(tc)
-        target.appendChild(tr)
+                if not isinstance(c, basestring):
+                    fmt = self._format(j)
+                    c = fmt % c if fmt is not None else c
+                if not isinstance(c, unicode):
+                    c = unicode(c)
+                _append_text(x, x.sub(x.sub(tc, 'w:p'), 'w:r'), c)
 
 class Figure(object):
     '''External image.
+
+    size is the displayed size in inches. options are the
+    imaging.ImageOptions for this image; the default are the images options
+    of the document.
     '''
-    def __init__(self, fname, size, caption = None):
+    __slots__ = ('fname', 'size', 'caption', 'options')
+
+    def __init__(self, fname, size, caption = None, options = None):
         self.fname = fname
         self.size = size
+        self.options = options
         if caption is not None:
             self.caption = Caption('Figure', caption)
         else:
             self.caption = None
 
     def append_to(self, doc, target):
-        name = self._copy_media(doc)
-        media_id = doc.appendMedia(name)
-        p = target.ownerDocument.createElement('w:p')
-        r = target.ownerDocument.createElement('w:r')
-        drawing = target.ownerDocument.createElement('w:drawing')
-        inline = target.ownerDocument.createElement('wp:inline')
-        extent = target.ownerDocument.createElement('wp:extent')
-        extent.setAttribute('cx', '%.0f' % (self.size[0] * 911400))
-        extent.setAttribute('cy', '%.0f' % (self.size[1] * 911400))
-        inline.appendChild(extent)
-        docpr = target.ownerDocument.createElement('wp:docPr')
-        docpr.setAttribute('id', '1')
-        docpr.setAttribute('descr', 'Grafik 0')
-        docpr.setAttribute('name', name)
-        inline.appendChild(docpr)
-        cNvGraphicFramePr = target.ownerDocument.createElement('wp:cNvGraphicFramePr')
-        graphicFrameLocks = target.ownerDocument.createElement('a:graphicFrameLocks')
-        graphicFrameLocks.setAttribute('noChangeAspect', '1')
-        cNvGraphicFramePr.appendChild(graphicFrameLocks)
-        inline.appendChild(cNvGraphicFramePr)
-        graphic = target.ownerDocument.createElement('a:graphic')
-        graphicdata = target.ownerDocument.createElement('a:graphicData')
-        graphicdata.setAttribute('uri', 'http://schemas.openxmlformats.org/drawingml/2006/picture')
-        pic = target.ownerDocument.createElement('pic:pic')
-        pic.setAttribute('xmlns:pic', ns['pic'])
-        nvpicpr = target.ownerDocument.createElement('pic:nvPicPr')
-        cnvpr = target.ownerDocument.createElement('pic:cNvPr')
-        cnvpr.setAttribute('id', '1')
-        cnvpr.setAttribute('name', name)
-        nvpicpr.appendChild(cnvpr)
-        cnvpicpr = target.ownerDocument.createElement('pic:cNvPicPr')
-        nvpicpr.appendChild(cnvpicpr)
-        pic.appendChild(nvpicpr)
-        blipFill = target.ownerDocument.createElement('pic:blipFill')
-        blip = target.ownerDocument.createElement('a:blip')
-        blip.setAttribute('r:embed', media_id)
-        blip.setAttribute('cstate', 'print')
-        blipFill.appendChild(blip)
-        stretch = target.ownerDocument.createElement('a:stretch')
-        fillRect = target.ownerDocument.createElement('a:fillRect')
-        stretch.appendChild(fillRect)
-        blipFill.appendChild(stretch)
-        pic.appendChild(blipFill)
-        sppr = target.ownerDocument.createElement('pic:spPr')
-        xfrm = target.ownerDocument.createElement('a:xfrm')
-        off = target.ownerDocument.createElement('a:off')
-        off.setAttribute('x', '0')
-        off.setAttribute('y', '0')
-        xfrm.appendChild(off)
-        ext = target.ownerDocument.createElement('a:ext')
-        ext.setAttribute('cx', '%.0f' % (self.size[0] * 911400))
-        ext.setAttribute('cy', '%.0f' % (self.size[1] * 911400))
-        xfrm.appendChild(ext)
-        sppr.appendChild(xfrm)
-        prstGeom = target.ownerDocument.createElement('a:prstGeom')
-        prstGeom.setAttribute('prst', 'rect')
-        sppr.appendChild(prstGeom)
-        pic.appendChild(sppr)
-        graphicdata.appendChild(pic)
-        graphic.appendChild(graphicdata)
-        inline.appendChild(graphic)
-        drawing.appendChild(inline)
-        r.appendChild(drawing)
-        p.appendChild(r)
-        target.appendChild(p)
+        x = doc.xml
+        name, media_id = self._append_media(doc)
+        cx = '%.0f' % (self.size[0] * 911400)
+        cy = '%.0f' % (self.size[1] * 911400)
+        p = x.sub(target, 'w:p')
+        r = x.sub(p, 'w:r')
+        drawing = x.sub(r, 'w:drawing')
+        inline = x.sub(drawing, 'wp:inline')
+        x.sub(inline, 'wp:extent', { 'cx':cx, 'cy':cy })
+        x.sub(inline, 'wp:docPr', { 'id':'1', 'descr':'Grafik 0', 
+                                    'name':name })
+        cNvGraphicFramePr = x.sub(inline, 'wp:cNvGraphicFramePr')
+        x.sub(cNvGraphicFramePr, 'a:graphicFrameLocks', 
+              { 'noChangeAspect':'1' })
+        graphic = x.sub(inline, 'a:graphic')
+        graphicdata = x.sub(graphic, 'a:graphicData', { 
+                'uri':'http://schemas.openxmlformats.org/drawingml/2006/picture' })
+        pic = x.sub(graphicdata, 'pic:pic', { 'xmlns:pic':ns['pic'] })
+        nvpicpr = x.sub(pic, 'pic:nvPicPr')
+        x.sub(nvpicpr, 'pic:cNvPr', { 'id':'1', 'name':name })
+        x.sub(nvpicpr, 'pic:cNvPicPr')
+        blipFill = x.sub(pic, 'pic:blipFill')
+        x.sub(blipFill, 'a:blip', { 'r:embed':media_id, 'cstate':'print' })
+        stretch = x.sub(blipFill, 'a:stretch')
+        x.sub(stretch, 'a:fillRect')
+        sppr = x.sub(pic, 'pic:spPr')
+        xfrm = x.sub(sppr, 'a:xfrm')
+        x.sub(xfrm, 'a:off', { 'x':'0', 'y':'0' })
+        x.sub(xfrm, 'a:ext', { 'cx':cx, 'cy':cy })
+        x.sub(sppr, 'a:prstGeom', { 'prst':'rect' })
         if self.caption is not None:
             self.caption.append_to(doc, target)
 
-    def _copy_media(self, doc):
-        newname = os.path.basename(self.fname)
-        shutil.copy(self.figure, os.path.join(doc.mediadir, newname))
-        return newname
+    def _append_media(self, doc):
+        '''Add the image to the document and return its name and reference.
+        '''
+        name = os.path.basename(self.fname)
+        with io.open(self.fname, 'rb') as fp:
+            data = imaging.downsample(fp.read(), self.size, 
+                                      self.options or doc.images)
+        return name, doc.appendMedia(name, data)
 
 class MatplotlibFigure(Figure):
     '''Image made from a matplotlib figure
+
+    A copy of the figure is taken (pickled) when it is appended, and
+    rasterized in a worker process, so that many figures are rendered in
+    parallel. The figure may be changed or reused right away. Figures that
+    cannot be pickled are rendered when they are appended.
+
+    size is the displayed size in inches, by default the size of the
+    figure.
     '''
-    def __init__(self, fig, caption = None):
-        Figure.__init__(self, 'matplotlib', fig.get_size_inches(), caption)
+    __slots__ = ('fig',)
+
+    def __init__(self, fig, caption = None, size = None, options = None):
+        if size is None:
+            size = fig.get_size_inches()
+        Figure.__init__(self, 'matplotlib', size, caption, options)
         self.fig = fig
 
-    def _copy_media(self, doc):
+    def _append_media(self, doc):
         FigureCanvasAgg(self.fig)
-        tmpf = tempfile.mkstemp(dir = doc.mediadir, prefix = 'image',
-                                suffix = '.png')
-        os.close(tmpf[0])
-        self.fig.savefig(tmpf[1], format = 'png', dpi=300)
-        return os.path.basename(tmpf[1])
+        options = self.options or doc.images
+        format = options.format if options.format == 'jpeg' else 'png'
+        name = 'image.%s' % imaging.extensions[format]
+        try:
+            state = pickle.dumps(self.fig, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            data = imaging.figure(self.fig, self.size, options)[1]
+            return name, doc.appendMedia(name, data)
+        return name, doc._submit_media(name, _render_figure, state, 
+                                       self.size, options)
+
+def _render_figure(state, size, options):
+    '''Render a pickled matplotlib figure (in a worker process).
+    '''
+    fig = pickle.loads(state)
+    FigureCanvasAgg(fig)
+    return imaging.figure(fig, size, options)[1]
 
 class PageBreak(object):
     '''Page break
     '''
+    __slots__ = ()
+
     def append_to(self, doc, target):
-        p = target.ownerDocument.createElement('w:p')
-        r = target.ownerDocument.createElement('w:r')
-        br = target.ownerDocument.createElement('w:br')
-        br.setAttribute('w:type', 'page')
-        r.appendChild(br)
-        p.appendChild(r)
-        target.appendChild(p)
+        x = doc.xml
+        p = x.sub(target, 'w:p')
+        r = x.sub(p, 'w:r')
+        x.sub(r, 'w:br', { 'w:type':'page' })
 
 class List(object):
     '''(Unnumbered) List
     '''
 
     bullets = [ u'●', u'○', '-', u'•', u'◦', u'-', u'▪', u'▫', u'-' ]
+    __slots__ = ('style', 'align', 'format', 'indent', 'hanging', 'rows')
 
     def __init__(self, rows = None, style = None, align = None, format = None):
         self.style = style
@@ -768,22 +2288,49 @@ class List(object):
                 row.append_to(doc, target, numbering = numId, indent = indent)
 
 class Numbering(object):
-    def __init__(self, sfile = None):
+    def __init__(self, xml, sfile = None):
+        self.xml = xml
         self.nums = dict()
         self.maxnumber = 0
         if sfile is not None:
-            self.doc = minidom.parse(sfile)
-            for n in self.doc.getElementsByTagName('w:num'):
-                num = int(n.getAttribute('w:numId'))
+            self.doc = xml.parse(sfile)
+            for n in xml.iter(self.doc, 'w:num'):
+                num = int(xml.get(n, 'w:numId'))
                 self.maxnumber = max(self.maxnumber, num)
-            for an in self.doc.getElementsByTagName('w:abstractNum'):
-                num = int(n.getAttribute('w:abstractNumId'))
+            for an in xml.iter(self.doc, 'w:abstractNum'):
+                num = int(xml.get(an, 'w:abstractNumId'))
                 self.maxnumber = max(self.maxnumber, num + 1)
         else:
-            self.doc = minidom.Document()
-            n = self.doc.createElement('w:numbering')
-            n.setAttribute('xmlns:w', ns['w'])
-            self.doc.appendChild(n)
+            self.doc = xml.document('w:numbering', { 'xmlns:w':ns['w'] })
+
+    def merge(self, other):
+        '''Move the list definitions of another Numbering into this one.
+
+        Returns a mapping of the old numIds to the new ones.
+        '''
+        x = self.xml
+        nums = x.iter(self.doc, 'w:num')
+        first = nums[0] if nums else None
+        abstracts = { }
+        for an in x.iter(other.doc, 'w:abstractNum'):
+            abstracts[x.get(an, 'w:abstractNumId')] = '%i' % self.maxnumber
+            x.set(an, 'w:abstractNumId', '%i' % self.maxnumber)
+            self.maxnumber += 1
+            x.remove(other.doc, an)
+            if first is not None:
+                x.insert_before(self.doc, an, first)
+            else:
+                x.append(self.doc, an)
+        numbers = { }
+        for num in x.iter(other.doc, 'w:num'):
+            self.maxnumber += 1
+            numbers[x.get(num, 'w:numId')] = '%i' % self.maxnumber
+            x.set(num, 'w:numId', '%i' % self.maxnumber)
+            for ref in x.iter(num, 'w:abstractNumId'):
+                x.set(ref, 'w:val', abstracts.get(x.get(ref, 'w:val'), ''))
+            x.remove(other.doc, num)
+            x.append(self.doc, num)
+        return numbers
 
     def _get_format(self, content, level = 0):
         for cstart, c in enumerate(content):
@@ -815,23 +2362,18 @@ class Numbering(object):
         return start, fmt, txt
 
     def _new_numbering(self):
-        an = self.doc.createElement('w:abstractNum')
-        an.setAttribute('w:abstractNumId', '%i' % self.maxnumber)
-        nums = self.doc.getElementsByTagName('w:num')
-        rootElement = self.doc.getElementsByTagName('w:numbering')[0]
+        x = self.xml
+        an = x.create(self.doc, 'w:abstractNum', 
+                      { 'w:abstractNumId':'%i' % self.maxnumber })
+        nums = x.iter(self.doc, 'w:num')
         if nums:
-            rootElement.insertBefore(an, nums[0])
+            x.insert_before(self.doc, an, nums[0])
         else:
-            rootElement.appendChild(an)
-        hml = self.doc.createElement('w:multiLevelType')
-        hml.setAttribute('w:val', 'hybridMultilevel')
-        an.appendChild(hml)
-        num = self.doc.createElement('w:num')
-        num.setAttribute('w:numId', '%i' % (self.maxnumber + 1))
-        ani = self.doc.createElement('w:abstractNumId')
-        ani.setAttribute('w:val', '%i' % self.maxnumber)
-        num.appendChild(ani)
-        rootElement.appendChild(num)
+            x.append(self.doc, an)
+        x.sub(an, 'w:multiLevelType', { 'w:val':'hybridMultilevel' })
+        num = x.sub(self.doc, 'w:num', 
+                    { 'w:numId':'%i' % (self.maxnumber + 1) })
+        x.sub(num, 'w:abstractNumId', { 'w:val':'%i' % self.maxnumber })
         self.maxnumber += 1
         self.nums[self.maxnumber] = { 0:an }
         return an, self.maxnumber
@@ -847,29 +2389,20 @@ class Numbering(object):
             level = 0
             an, numId = self._new_numbering()
 
-        lvl = self.doc.createElement('w:lvl')
-        lvl.setAttribute('w:ilvl', '%i' % level)
+        x = self.xml
+        lvl = x.sub(an, 'w:lvl', { 'w:ilvl':'%i' % level })
         start, fmt, txt = self._get_format(content, level)
         if start:
-            st = self.doc.createElement('w:start')
-            st.setAttribute('w:val', '%i' % start)
-            lvl.appendChild(st)
+            x.sub(lvl, 'w:start', { 'w:val':'%i' % start })
         if fmt:
-            numfmt = self.doc.createElement('w:numFmt')
-            numfmt.setAttribute('w:val', fmt)
-            lvl.appendChild(numfmt)
+            x.sub(lvl, 'w:numFmt', { 'w:val':fmt })
         if txt:
-            lvltext = self.doc.createElement('w:lvlText')
-            lvltext.setAttribute('w:val', txt)
-            lvl.appendChild(lvltext)
+            x.sub(lvl, 'w:lvlText', { 'w:val':txt })
         if indent or hanging:
-            pPr = self.doc.createElement('w:pPr')
-            ind = self.doc.createElement('w:ind')
+            pPr = x.sub(lvl, 'w:pPr')
+            ind = x.sub(pPr, 'w:ind')
             if indent:
-                ind.setAttribute('w:left', '%i' % indent)
+                x.set(ind, 'w:left', '%i' % indent)
             if hanging:
-                ind.setAttribute('w:hanging', '%i' % hanging)
-            pPr.appendChild(ind)
-            lvl.appendChild(pPr)
-        an.appendChild(lvl)
+                x.set(ind, 'w:hanging', '%i' % hanging)
         return (level, numId)
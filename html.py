@@ -1,8 +1,9 @@
-import codecs
 import os
 import tempfile
 import shutil
-from xml.dom import minidom
+
+import xmltree
+import imaging
 
 try:
     import matplotlib.figure
@@ -11,20 +12,87 @@ try:
 except:
     _have_matplotlib = False
 
+try:
+    import fcntl
+    _FICLONE = 0x40049409
+except ImportError:
+    fcntl = None
+
+try:
+    unicode
+except NameError:
+    unicode = str
+
+def _reflink(src, dst):
+    '''Clone src to dst with a reflink (copy-on-write copy), if the file
+    system supports it. Returns whether this succeeded.
+    '''
+    if fcntl is None:
+        return False
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+                cloned = True
+            except (IOError, OSError):
+                cloned = False
+    if not cloned:
+        os.remove(dst)
+    return cloned
+
+def _sync_file(src, dst, synced):
+    '''Make dst a copy of src, unless it is one already.
+
+    dst is a hardlink to src if both are on the same file system, else a
+    reflink or a plain copy. synced maps the targets to the state of their
+    sources when they were last copied. Returns whether dst was changed.
+    '''
+    s = os.stat(src)
+    state = (s.st_dev, s.st_ino, s.st_size, s.st_mtime)
+    try:
+        d = os.stat(dst)
+    except OSError:
+        d = None
+    if d is not None:
+        if (d.st_dev, d.st_ino) == (s.st_dev, s.st_ino) or \
+                synced.get(dst) == state:
+            return False
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError):
+        if not _reflink(src, dst):
+            shutil.copy(src, dst)
+    synced[dst] = state
+    return True
+
+def _unlink(fname):
+    '''Remove fname if it exists.
+
+    Media files are always replaced instead of rewritten, as they may be
+    hardlinked to the images of a written document.
+    '''
+    if os.path.exists(fname):
+        os.remove(fname)
+
 class Document(object):
-    def __init__(self, fname = None, mode = 'copyonwrite'):
+    def __init__(self, fname = None, mode = 'copyonwrite', 
+                 backend = 'minidom'):
         self.fname = fname
         self.mode = mode
+        self.xml = xmltree.get(backend)
         self.tmpdir = tempfile.mkdtemp(prefix = 'html')
         self.mediadir = os.path.join(self.tmpdir, 'images')
         self.property = dict()
+        self.images = imaging.ImageOptions()
+        self._synced = dict()
         os.mkdir(self.mediadir)
 
-        if fname is None or mode is 'create':
+        if fname is None or mode == 'create':
             self._createdefault()
         elif os.path.exists(fname):
             self._load(fname)
-        elif mode is 'create' or mode is 'append':
+        elif mode == 'create' or mode == 'append':
             self._createdefault()
         else:
             raise IOError('%s does not exist' % fname)
@@ -38,28 +106,23 @@ class Document(object):
             'div.figure': {'width':'85%' },
             'div.table': {'width':'85%' },
             }
-        doc = minidom.Document()
-        wdoc = doc.createElement('html')
-        doc.appendChild(wdoc)
-        self.header = doc.createElement('head')
+        x = self.xml
+        self._root = x.document('html')
+        self.header = x.sub(self._root, 'head')
         v = ''
         for name, style in self.styles.items():
             s0 = '\n'
             for p, s in style.items():
                 s0 += '  %s: %s;\n' % (p,s)
             v += '%s {\n%s}\n' % (name, s0)
-        st = doc.createElement('style')
-        st.setAttribute('type', 'text/css')
-        st.appendChild(doc.createTextNode(v))
-        self.header.appendChild(st)
-        wdoc.appendChild(self.header)
-        self.body = doc.createElement('body')
-        wdoc.appendChild(self.body)
+        x.sub(self.header, 'style', { 'type':'text/css' }, v)
+        self.body = x.sub(self._root, 'body')
 
     def _load(self, filename):
-        wdoc = minidom.parse(open(filename)).documentElement
-        self.body = wdoc.getElementsByTagName('body')[0]
-        self.header = wdoc.getElementsByTagName('head')[0]
+        x = self.xml
+        self._root = x.parse(open(filename, "rb"))
+        self.body = x.iter(self._root, 'body')[0]
+        self.header = x.iter(self._root, 'head')[0]
 
     def __iadd__(self, other):
         if isinstance(other, (str, unicode)):
@@ -73,20 +136,18 @@ class Document(object):
         return self
 
     def writeto(self, filename):
-        fp = codecs.open(filename, 'w', 'utf-8')
+        fp = open(filename, 'wb')
         for key, value in self.property.items():
-            st = self.header.ownerDocument.createElement('meta')
-            st.setAttribute('name', key)
-            st.setAttribute('content', value)
-            self.header.appendChild(st)
-        self.body.ownerDocument.writexml(fp, encoding = "UTF-8")
-#        self.body.ownerDocument.writexml(fp, "", "  ", "\n", encoding = "UTF-8")
+            self.xml.sub(self.header, 'meta', 
+                         { 'name':key, 'content':value })
+        fp.write(self.xml.tostring(self._root))
         images = os.path.join(os.path.dirname(filename), 
                               os.path.basename(self.mediadir))
         if not os.path.exists(images):
             os.mkdir(images)
         for f in os.listdir(self.mediadir):
-            shutil.copy(os.path.join(self.mediadir, f), images)
+            _sync_file(os.path.join(self.mediadir, f), 
+                       os.path.join(images, f), self._synced)
         fp.close()
 
     def flush(self):
@@ -95,7 +156,7 @@ class Document(object):
         This works only if the document was opened in 'update' or 'append'
         mode.
         '''
-        if ((self.mode is 'update' or self.mode is 'append') 
+        if ((self.mode == 'update' or self.mode == 'append') 
             and self.fname is not None):
             self.writeto(self.fname)
 
@@ -112,6 +173,8 @@ class Text(object):
     '''Structure containing some text with the same formatting options.
     
     '''
+    __slots__ = ('content', 'bold', 'italic', 'underline')
+
     def __init__(self, content, bold = None, italic = None, underline = None):
         self.content = content if isinstance(content, unicode) \
             else unicode(content)
@@ -120,7 +183,6 @@ class Text(object):
         self.underline = underline
 
     def append_to(self, doc, target):
-        p = target.ownerDocument.createElement('span')
         style = ''
         if self.bold is not None:
             style += 'font-weight: %s; ' % ('bold' if self.bold else 'normal')
@@ -138,14 +200,17 @@ class Text(object):
                 ';':'underline',
                 }
             style += 'text-decoration: %s;' % styles[self.styles]
-        if style:
-            p.setAttribute('style', style)
-        p.appendChild(target.ownerDocument.createTextNode(self.content.strip()))
-        target.appendChild(p)
+        doc.xml.sub(target, 'span', { 'style':style } if style else None,
+                    self.content.strip())
 
 class Paragraph(object):
     '''Structure containing one text paragraph.
+
+    content holds Text and List objects, and plain strings for unformatted
+    text.
     '''
+    __slots__ = ('style', 'align', 'content')
+
     def __init__(self, content = None, style = None, align = None):
         self.style = style
         self.align = align
@@ -154,11 +219,13 @@ class Paragraph(object):
             self.__iadd__(content)
 
     def __iadd__(self, other):
-        self.content.append(other if isinstance(other, (Text, List)) else Text(other))
+        if isinstance(other, (Text, List, unicode)):
+            self.content.append(other)
+        else:
+            self.content.append(unicode(other))
         return self
 
     def append_to(self, doc, target):
-        p = target.ownerDocument.createElement(self.style or 'p')
         styles = ''
         alignments = {
             'l':'left', 'left':'left', '<':'left',
@@ -169,21 +236,27 @@ class Paragraph(object):
         a = alignments.get(self.align)
         if a:
             styles += 'alignment:%s; ' % a
-        if styles:
-            p.setAttribute('style', styles)
+        p = doc.xml.sub(target, self.style or 'p', 
+                        { 'style':styles } if styles else None)
         for c in self.content:
-            c.append_to(doc, p)
-        target.appendChild(p)
+            if isinstance(c, unicode):
+                doc.xml.sub(p, 'span', None, c.strip())
+            else:
+                c.append_to(doc, p)
 
 class Header(Paragraph):
     '''Caption header.
     '''
+    __slots__ = ()
+
     def __init__(self, level, content):
         Paragraph.__init__(self, content, style = 'h%i' % level)
 
 class List(object):
     '''(Unnumbered) List
     '''
+    __slots__ = ('format', 'align', 'rows')
+
     def __init__(self, rows = None, align = None, format = None):
         self.format = format
         self.align = align
@@ -209,18 +282,18 @@ class List(object):
     def append_to(self, doc, target):
         a = self.format[0] if self.format else None
         if a in ('1', 'a', 'A', 'i', 'I'):
-            p = target.ownerDocument.createElement('ol')
+            p = doc.xml.sub(target, 'ol')
         else:
-            p = target.ownerDocument.createElement('ul')
+            p = doc.xml.sub(target, 'ul')
         for row in self.rows:
-            li = target.ownerDocument.createElement('li')
+            li = doc.xml.sub(p, 'li')
             row.append_to(doc, li)
-            p.appendChild(li)
-        target.appendChild(p)
 
 class Caption(Paragraph):
     '''Table or figure caption
     '''
+    __slots__ = ()
+
     def __init__(self, name, content):
         Paragraph.__init__(self, content)
         self.content.insert(0, Text(name + ': ', bold=True))
@@ -230,6 +303,8 @@ class Table(object):
     
     cells should be a 2dim array.
     '''
+    __slots__ = ('cells', 'caption', 'style')
+
     def __init__(self, cells, caption = None, style = None):
         self.cells = cells
         if caption is not None:
@@ -239,35 +314,35 @@ class Table(object):
         self.style = style
 
     def append_to(self, doc, target):
-        d = target.ownerDocument.createElement('div')
-        d.setAttribute('class', 'table')
+        d = doc.xml.sub(target, 'div', { 'class':'table' })
         if self.caption is not None:
             self.caption.append_to(doc, d)
-        tbl = target.ownerDocument.createElement('table')
+        tbl = doc.xml.sub(d, 'table')
         for row in self.cells:
             self._append_row_to(doc, tbl, row)
-        d.appendChild(tbl)
-        target.appendChild(d)
 
     def _append_row_to(self, doc, target, row):
-        tr = target.ownerDocument.createElement('tr')
+        tr = doc.xml.sub(target, 'tr')
         for c in row:
-            tc = target.ownerDocument.createElement('td')
+            tc = doc.xml.sub(tr, 'td')
             if isinstance(c, Paragraph):
                 c.append_to(doc, tc)
-            elif isinstance(c, (str, unicode, Text)):
-                Paragraph(c).append_to(doc, tc)
             else:
-                Paragraph(c).append_to(doc, str(tc))
-            tr.appendChild(tc)
-        target.appendChild(tr)
+                Paragraph(c).append_to(doc, tc)
 
 class Figure(object):
     '''External image.
+
+    size is the displayed size in inches. options are the
+    imaging.ImageOptions for this image; the default are the images options
+    of the document.
     '''
-    def __init__(self, fname, size, caption = None):
+    __slots__ = ('fname', 'size', 'caption', 'options')
+
+    def __init__(self, fname, size, caption = None, options = None):
         self.fname = fname
         self.size = size
+        self.options = options
         if caption is not None:
             self.caption = Caption('Figure', caption)
         else:
@@ -275,40 +350,57 @@ class Figure(object):
 
     def append_to(self, doc, target):
         name = self._copy_media(doc)
-        d = target.ownerDocument.createElement('div')
-        d.setAttribute('class', 'figure')
-        i = target.ownerDocument.createElement('img')
-        i.setAttribute('src', os.path.join(os.path.basename(doc.mediadir), 
-                                           name))
-        i.setAttribute('width', '100%')
-        d.appendChild(i)
+        d = doc.xml.sub(target, 'div', { 'class':'figure' })
+        doc.xml.sub(d, 'img', { 
+                'src':os.path.join(os.path.basename(doc.mediadir), name),
+                'width':'100%' })
         if self.caption is not None:
             self.caption.append_to(doc, d)
-        target.appendChild(d)
 
     def _copy_media(self, doc):
         newname = os.path.basename(self.fname)
-        shutil.copy(self.figure, os.path.join(doc.mediadir, newname))
+        with open(self.fname, 'rb') as fp:
+            data = fp.read()
+        scaled = imaging.downsample(data, self.size, 
+                                    self.options or doc.images)
+        target = os.path.join(doc.mediadir, newname)
+        _unlink(target)
+        if scaled is data:
+            shutil.copy(self.fname, target)
+        else:
+            with open(target, 'wb') as fp:
+                fp.write(scaled)
         return newname
 
 class MatplotlibFigure(Figure):
     '''Image made from a matplotlib figure
+
+    size is the displayed size in inches, by default the size of the
+    figure.
     '''
-    def __init__(self, fig, caption = None):
-        Figure.__init__(self, 'matplotlib', fig.get_size_inches(), caption)
+    __slots__ = ('fig',)
+
+    def __init__(self, fig, caption = None, size = None, options = None):
+        if size is None:
+            size = fig.get_size_inches()
+        Figure.__init__(self, 'matplotlib', size, caption, options)
         self.fig = fig
 
     def _copy_media(self, doc):
         FigureCanvasAgg(self.fig)
+        ext, data = imaging.figure(self.fig, self.size, 
+                                   self.options or doc.images,
+                                   ('png', 'jpeg', 'svg'))
         tmpf = tempfile.mkstemp(dir = doc.mediadir, prefix = 'image',
-                                suffix = '.png')
-        os.close(tmpf[0])
-        self.fig.savefig(tmpf[1], format = 'png', dpi=300)
+                                suffix = '.' + ext)
+        with os.fdopen(tmpf[0], 'wb') as fp:
+            fp.write(data)
         return os.path.basename(tmpf[1])
 
 class PageBreak(object):
     '''Page break
     '''
+    __slots__ = ()
+
     def append_to(self, doc, target):
-        p = target.ownerDocument.createElement('hline')
-        target.appendChild(p)
+        doc.xml.sub(target, 'hline')
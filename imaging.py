@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+'''Image encoding for the docx and html writers.
+
+Images are encoded for the size at which they are displayed: matplotlib
+figures are rasterized at the target resolution, and external images that
+are much larger than needed are scaled down (this needs PIL or Pillow).
+'''
+
+import io
+
+try:
+    from PIL import Image
+    _have_pil = True
+except ImportError:
+    _have_pil = False
+
+class ImageOptions(object):
+    '''Encoding options for the images of a document.
+
+    dpi: Target resolution, in pixels per displayed inch. The default is
+         what Word uses for print quality.
+    format: 'png', 'jpeg' or 'svg'. Formats that are not supported by a
+            document type fall back to 'png'.
+    quality: JPEG quality (1..95).
+    downsample: Scale down external images that have more than dpi pixels
+                per displayed inch.
+    '''
+    def __init__(self, dpi = 220, format = 'png', quality = 85,
+                 downsample = True):
+        self.dpi = dpi
+        self.format = format
+        self.quality = quality
+        self.downsample = downsample
+
+extensions = { 'png':'png', 'jpeg':'jpg', 'svg':'svg' }
+
+def figure(fig, size, options, formats = ('png', 'jpeg')):
+    '''Render a matplotlib figure for the displayed size (in inches).
+
+    Returns the file extension and the encoded image.
+    '''
+    format = options.format if options.format in formats else 'png'
+    width = fig.get_size_inches()[0]
+    kwargs = { }
+    if format == 'jpeg':
+        kwargs['pil_kwargs'] = { 'quality':options.quality }
+    fp = io.BytesIO()
+    dpi = float(options.dpi) * size[0] / width
+    fig.savefig(fp, format = format, dpi = dpi, **kwargs)
+    return extensions[format], fp.getvalue()
+
+def downsample(data, size, options):
+    '''Scale down an encoded image to the resolution that is needed for the
+    displayed size (in inches).
+
+    The image is returned unchanged if it is small enough, if it is not a
+    PNG or JPEG image, or if PIL is not available.
+    '''
+    if not options.downsample or not _have_pil:
+        return data
+    try:
+        img = Image.open(io.BytesIO(data))
+    except IOError:
+        return data
+    if img.format not in ('PNG', 'JPEG'):
+        return data
+    width, height = img.size
+    dpi = float(options.dpi)
+    scale = max(size[0] * dpi / width, size[1] * dpi / height)
+    if scale >= 1:
+        return data
+    format = img.format
+    img = img.resize((max(1, int(width * scale + 0.5)), 
+                      max(1, int(height * scale + 0.5))), Image.LANCZOS)
+    fp = io.BytesIO()
+    if format == 'JPEG':
+        img.save(fp, format, quality = options.quality)
+    else:
+        img.save(fp, format, optimize = True)
+    return fp.getvalue() if fp.tell() < len(data) else data
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+'''XML tree backends for the docx and html writers.
+
+A backend wraps one XML tree implementation behind the small set of
+operations that the document classes need. Elements are always addressed
+by their prefixed names (like 'w:p'), and namespace declarations are kept as
+ordinary 'xmlns:...' attributes, so that the same code works with every
+backend.
+
+Available backends are 'minidom' (pure Python, the default) and 'etree'
+(cElementTree, which is much faster and needs far less memory per node).
+'''
+
+from xml.dom import minidom
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+_xml_namespace = 'http://www.w3.org/XML/1998/namespace'
+
+def get(backend = 'minidom'):
+    '''Return the backend with the given name.
+
+    backend may also be a backend instance, which is returned unchanged.
+    '''
+    if isinstance(backend, Backend):
+        return backend
+    try:
+        return backends[backend]
+    except KeyError:
+        raise ValueError('Unknown XML backend %r' % backend)
+
+class Backend(object):
+    '''Common interface of the XML tree backends.
+
+    Backends implement these operations:
+
+    document(tag, attrs): Create a new document and return its root.
+    parse(fp): Parse an XML file and return its root element.
+    tostring(root): Serialize a document, with the XML declaration.
+    fragment(el): Serialize an element.
+    create(ref, tag, attrs, text): Create an element for the document of
+                                   ref, without appending it.
+    append(parent, child), insert_before(parent, child, ref),
+    remove(parent, child), replace(parent, new, old): Change the children
+                                                      of an element.
+    release(el): Free the memory of an element that is no longer used.
+    children(el, start): The child elements of el, beginning at the child
+                         node start (as counted by count()).
+    count(el): The number of child nodes of el. Depending on the backend,
+               this may include text nodes.
+    iter(el, tag): The elements below el (not el itself) with a tag, or
+                   all of them for '*'.
+    parents(root): A mapping from the elements below root to their parents.
+    tag(el), get(el, name), attributes(el), set(el, name, value),
+    text(el), set_text(el, text): Access the name, attributes and text of
+                                  an element.
+    '''
+    name = None
+    # Whether one element may be appended to several parents, so that
+    # unchanging elements can be cached and shared.
+    shared = False
+
+    def sub(self, parent, tag, attrs = None, text = None):
+        '''Create a new element and append it to parent.
+        '''
+        el = self.create(parent, tag, attrs, text)
+        self.append(parent, el)
+        return el
+
+class _ParentNode(object):
+    def __getitem__(self, node):
+        return node.parentNode
+
+class Minidom(Backend):
+    '''Backend based on xml.dom.minidom.
+    '''
+    name = 'minidom'
+
+    def document(self, tag, attrs = None):
+        doc = minidom.Document()
+        root = self.create(doc, tag, attrs)
+        doc.appendChild(root)
+        return root
+
+    def parse(self, fp):
+        return minidom.parse(fp).documentElement
+
+    def tostring(self, root):
+        return root.ownerDocument.toxml('UTF-8')
+
+    def fragment(self, el):
+        return el.toxml('UTF-8')
+
+    def create(self, ref, tag, attrs = None, text = None):
+        doc = ref if ref.nodeType == ref.DOCUMENT_NODE else ref.ownerDocument
+        el = doc.createElement(tag)
+        if attrs:
+            for name, value in attrs.items():
+                el.setAttribute(name, value)
+        if text is not None:
+            el.appendChild(doc.createTextNode(text))
+        return el
+
+    def append(self, parent, child):
+        parent.appendChild(child)
+
+    def insert_before(self, parent, child, ref):
+        parent.insertBefore(child, ref)
+
+    def remove(self, parent, child):
+        parent.removeChild(child)
+
+    def replace(self, parent, new, old):
+        parent.replaceChild(new, old)
+
+    def release(self, el):
+        el.unlink()
+
+    def children(self, el, start = 0):
+        return [n for n in el.childNodes[start:] 
+                if n.nodeType == n.ELEMENT_NODE]
+
+    def count(self, el):
+        return len(el.childNodes)
+
+    def iter(self, el, tag):
+        return el.getElementsByTagName(tag)
+
+    def tag(self, el):
+        return el.tagName
+
+    def get(self, el, name):
+        return el.getAttribute(name)
+
+    def attributes(self, el):
+        return list(el.attributes.items())
+
+    def set(self, el, name, value):
+        el.setAttribute(name, value)
+
+    def text(self, el):
+        return u''.join(n.data for n in el.childNodes
+                        if n.nodeType == n.TEXT_NODE)
+
+    def set_text(self, el, text):
+        for n in [n for n in el.childNodes if n.nodeType == n.TEXT_NODE]:
+            el.removeChild(n)
+        el.appendChild(el.ownerDocument.createTextNode(text))
+
+    def parents(self, root):
+        return _ParentNode()
+
+class ETree(Backend):
+    '''Backend based on (c)ElementTree.
+    '''
+    name = 'etree'
+    shared = True
+
+    def document(self, tag, attrs = None):
+        return self.create(None, tag, attrs)
+
+    def parse(self, fp):
+        '''Parse an XML file and replace the expanded names of elements and
+        attributes by their prefixed names.
+        '''
+        prefixes = { _xml_namespace: 'xml' }
+        declarations = [ ]
+        root = None
+        for event, item in ElementTree.iterparse(fp, ('start-ns', 'start')):
+            if event == 'start-ns':
+                prefix, uri = item
+                prefixes[uri] = prefix
+                declarations.append((('xmlns:%s' % prefix) if prefix
+                                     else 'xmlns', uri))
+                continue
+            if root is None:
+                root = item
+            item.tag = self._qname(item.tag, prefixes)
+            attrs = item.items()
+            item.attrib.clear()
+            for name, value in attrs:
+                item.set(self._qname(name, prefixes), value)
+            for name, value in declarations:
+                item.set(name, value)
+            declarations = [ ]
+        return root
+
+    @staticmethod
+    def _qname(name, prefixes):
+        if name[0] != '{':
+            return name
+        uri, local = name[1:].split('}', 1)
+        prefix = prefixes.get(uri)
+        return '%s:%s' % (prefix, local) if prefix else local
+
+    def tostring(self, root):
+        return (b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                + ElementTree.tostring(root, encoding = 'utf-8'))
+
+    def fragment(self, el):
+        tail, el.tail = el.tail, None
+        s = ElementTree.tostring(el, encoding = 'utf-8')
+        el.tail = tail
+        return s
+
+    def create(self, ref, tag, attrs = None, text = None):
+        el = ElementTree.Element(tag, attrs or { })
+        el.text = text
+        return el
+
+    def append(self, parent, child):
+        parent.append(child)
+
+    def insert_before(self, parent, child, ref):
+        parent.insert(list(parent).index(ref), child)
+
+    def remove(self, parent, child):
+        parent.remove(child)
+
+    def replace(self, parent, new, old):
+        parent[list(parent).index(old)] = new
+
+    def release(self, el):
+        el.clear()
+
+    def children(self, el, start = 0):
+        return el[start:]
+
+    def count(self, el):
+        return len(el)
+
+    def iter(self, el, tag):
+        return [n for n in el.iter(tag) if n is not el]
+
+    def tag(self, el):
+        return el.tag
+
+    def get(self, el, name):
+        return el.get(name, '')
+
+    def attributes(self, el):
+        return el.items()
+
+    def set(self, el, name, value):
+        el.set(name, value)
+
+    def text(self, el):
+        return el.text or u''
+
+    def set_text(self, el, text):
+        el.text = text
+
+    def parents(self, root):
+        return dict((c, p) for p in root.iter() for c in p)
+
+class Instrumented(Backend):
+    '''Wrapper around a backend that reports to an instrumentation object.
+
+    Parsing and serialization are timed as the phases 'parse' and
+    'serialize', and every created element is counted by stats.element().
+    '''
+    def __init__(self, backend, stats):
+        self.backend = backend
+        self.stats = stats
+        self.name = backend.name
+        self.shared = backend.shared
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def create(self, ref, tag, attrs = None, text = None):
+        self.stats.element()
+        return self.backend.create(ref, tag, attrs, text)
+
+    def parse(self, fp):
+        with self.stats.phase('parse'):
+            return self.backend.parse(fp)
+
+    def tostring(self, root):
+        with self.stats.phase('serialize'):
+            return self.backend.tostring(root)
+
+    def fragment(self, el):
+        with self.stats.phase('serialize'):
+            return self.backend.fragment(el)
+
+backends = {
+    'minidom': Minidom(),
+    'etree': ETree(),
+    }